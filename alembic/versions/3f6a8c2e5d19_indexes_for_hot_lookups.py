@@ -0,0 +1,88 @@
+"""Indexes for hot lookups
+
+Revision ID: 3f6a8c2e5d19
+Revises: 9d4e2b7f1a60
+Create Date: 2026-10-17 17:48:52.306118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6a8c2e5d19'
+down_revision = '9d4e2b7f1a60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+# (name, table, columns, unique)
+INDEXES = [
+    ('ix_users_name', 'users', ['name'], True),
+    ('ix_regions_name', 'regions', ['name'], True),
+    ('ix_regions_capital', 'regions', ['capital'], False),
+    ('ix_aliases_name', 'aliases', ['name'], True),
+    ('ix_codewords_user_id_code', 'codewords', ['user_id', 'code'], True),
+    ('ix_battles_submission_id', 'battles', ['submission_id'], False),
+    ('ix_marching_orders_arrival', 'marching_orders', ['arrival'], False),
+    ('ix_marching_orders_leader_id', 'marching_orders', ['leader_id'],
+     False),
+    ('ix_processed_battle_id', 'processed', ['battle_id'], False),
+    ('ix_skirmish_actions_comment_id', 'skirmish_actions', ['comment_id'],
+     False),
+    ('ix_skirmish_actions_battle_id', 'skirmish_actions', ['battle_id'],
+     False),
+    ('ix_skirmish_actions_participant_id', 'skirmish_actions',
+     ['participant_id'], False),
+    ('ix_skirmish_actions_parent_id', 'skirmish_actions', ['parent_id'],
+     False),
+]
+
+
+def create_indexes():
+    # The code has always avoided duplicate aliases and codewords, but
+    # nothing enforced it; keep the oldest alias and the newest codeword.
+    # Duplicate users or regions would need a human to sort out, so those
+    # are left to fail loudly.
+    op.execute("DELETE FROM aliases WHERE id NOT IN "
+               "(SELECT MIN(id) FROM aliases GROUP BY name)")
+    op.execute("DELETE FROM codewords WHERE id NOT IN "
+               "(SELECT MAX(id) FROM codewords GROUP BY user_id, code)")
+    for name, table, columns, unique in INDEXES:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def drop_indexes():
+    for name, table, columns, unique in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+
+
+def upgrade_engine1():
+    create_indexes()
+
+
+def downgrade_engine1():
+    drop_indexes()
+
+
+def upgrade_engine2():
+    create_indexes()
+
+
+def downgrade_engine2():
+    drop_indexes()
+
+
+def upgrade_engine3():
+    create_indexes()
+
+
+def downgrade_engine3():
+    drop_indexes()
+
@@ -0,0 +1,79 @@
+"""Added root_id and depth to SkirmishAction
+
+Revision ID: 7b2d94e1c3a8
+Revises: 3f6a8c2e5d19
+Create Date: 2026-10-17 18:31:07.462950
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b2d94e1c3a8'
+down_revision = '3f6a8c2e5d19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def add_columns():
+    op.add_column('skirmish_actions', sa.Column('root_id', sa.Integer(), nullable=True))
+    op.add_column('skirmish_actions', sa.Column('depth', sa.Integer(), server_default='0', nullable=True))
+    op.create_index('ix_skirmish_actions_root_id', 'skirmish_actions', ['root_id'], unique=False)
+    backfill()
+
+
+def backfill():
+    # Roots first, then one level further down each time round until
+    # there's nobody left to fill in
+    conn = op.get_bind()
+    conn.execute("UPDATE skirmish_actions SET root_id = id, depth = 0 "
+                 "WHERE parent_id IS NULL")
+    while True:
+        result = conn.execute(
+            "UPDATE skirmish_actions SET "
+            "root_id = (SELECT p.root_id FROM skirmish_actions p "
+            "           WHERE p.id = skirmish_actions.parent_id), "
+            "depth = (SELECT p.depth + 1 FROM skirmish_actions p "
+            "         WHERE p.id = skirmish_actions.parent_id) "
+            "WHERE root_id IS NULL AND parent_id IN "
+            "(SELECT id FROM skirmish_actions WHERE root_id IS NOT NULL)")
+        if not result.rowcount:
+            break
+
+
+def drop_columns():
+    op.drop_index('ix_skirmish_actions_root_id', table_name='skirmish_actions')
+    op.drop_column('skirmish_actions', 'depth')
+    op.drop_column('skirmish_actions', 'root_id')
+
+
+def upgrade_engine1():
+    add_columns()
+
+
+def downgrade_engine1():
+    drop_columns()
+
+
+def upgrade_engine2():
+    add_columns()
+
+
+def downgrade_engine2():
+    drop_columns()
+
+
+def upgrade_engine3():
+    add_columns()
+
+
+def downgrade_engine3():
+    drop_columns()
+
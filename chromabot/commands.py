@@ -1,20 +1,26 @@
+import hashlib
 import logging
-import os
 import re
 import socket
 import time
 import traceback
-from cStringIO import StringIO
 
 import praw
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 
 import db
-from db import Battle, Buff, Region, Processed, SkirmishAction, User
-from utils import now, num_to_team, team_to_num, timestr
+from db import (Battle, Buff, OutboundMessage, Region, Processed,
+                SkirmishAction, User)
+from utils import name_to_id, now, num_to_team, team_to_num, timestr
 from pathfinder import find_path
 
 
+# Everything that failable shrugs off
+REDDIT_ERRORS = (praw.errors.APIException, praw.errors.HTTPException,
+                 ConnectionError, Timeout, socket.timeout, socket.error,
+                 HTTPError)
+
+
 def failable(f):
     def wrapped(*args, **kwargs):
         try:
@@ -45,8 +51,12 @@ class Context(object):
         self.comment = comment  # a praw object
         self.reddit = reddit    # root praw object
 
-    @failable
-    def reply(self, reply, pm=True):
+    def reply(self, reply, pm=True, callback=None, callback_id=None):
+        """Queue a reply to the comment or message we're responding to
+
+        Nothing goes to reddit until the outbox is next sent, and the reply
+        is only kept if the session it was queued in is committed.
+        """
         verbose = self.config.bot.get("verbose_logging")
         was_comment = getattr(self.comment, 'was_comment', True)
         header = ""
@@ -56,17 +66,24 @@ class Context(object):
         else:  # It wasn't a comment, or pm = False
             if verbose:
                 logging.info("Replying: %s" % reply)
-            return self.comment.reply(reply)
+            return OutboundMessage.queue(self.session, "reply",
+                                         self.comment.name, reply,
+                                         callback=callback,
+                                         callback_id=callback_id)
 
         full_reply = "%s\n\n%s" % (header, reply)
         if verbose:
             logging.info("PMing: %s" % full_reply)
-        self.reddit.send_message(self.player.name, "Chromabot reply",
-                                 full_reply)
+        return OutboundMessage.queue(self.session, "pm", self.player.name,
+                                     full_reply, subject="Chromabot reply",
+                                     callback=callback,
+                                     callback_id=callback_id)
 
-    @failable
-    def submit(self, srname, title, text):
-        return self.reddit.submit(srname, title=title, text=text)
+    def submit(self, srname, title, text, callback=None, callback_id=None):
+        """Queue a new thread in the given subreddit"""
+        return OutboundMessage.queue(self.session, "submit", srname, text,
+                                     subject=title, callback=callback,
+                                     callback_id=callback_id)
 
     def team_name(self):
         return num_to_team(self.player.team, self.config)
@@ -102,10 +119,7 @@ class CodewordCommand(Command):
     def execute(self, context):
         if self.remove:
             if self.all:
-                cws = list(context.player.codewords)
-                for cw in cws:
-                    context.session.delete(cw)
-                context.session.commit()
+                context.player.remove_all_codewords()
                 context.reply("**Confirmed**:  You no longer have codewords")
             else:
                 context.player.remove_codeword(self.code)
@@ -179,18 +193,22 @@ class InvadeCommand(Command):
         self.where = tokens["where"].lower()
 
     @staticmethod
-    @failable
-    def post_invasion(title, battle, reddit):
+    def post_invasion(title, battle, session):
+        """Queue the thread the battle will be fought in
+
+        The battle learns its submission_id once the thread is posted.
+        """
         text = ("Negotiations have broken down, and the trumpets of "
                 "war have sounded.  Even now, civilians are being "
                 "evacuated and the able-bodied drafted.  The conflict "
                 "will soon be upon you.\n\n"
                 "Gather your forces while you can, for your enemy "
                 "shall arrive at %s") % battle.begins_str()
-        submitted = reddit.submit(battle.region.srname,
-                                   title=title,
-                                   text=text)
-        return submitted
+        return OutboundMessage.queue(session, "submit",
+                                     battle.region.srname, text,
+                                     subject=title,
+                                     callback="battle_submission",
+                                     callback_id=battle.id)
 
     def execute(self, context):
         dest = Region.get_region(self.where, context)
@@ -232,14 +250,8 @@ class InvadeCommand(Command):
                               battle.begins_str())
                 title = ("[Invasion] The %s armies march on %s!" %
                          (context.team_name(), dest.name))
-                submitted = InvadeCommand.post_invasion(title, battle,
-                                                        context.reddit)
-                if submitted:
-                    battle.submission_id = submitted.name
-                    context.session.commit()
-                else:
-                    logging.warn("Couldn't submit invasion thread")
-                    context.session.rollback()
+                InvadeCommand.post_invasion(title, battle, context.session)
+                context.session.commit()
 
 
 class MoveCommand(Command):
@@ -347,7 +359,8 @@ class MoveCommand(Command):
                     traverse_neutrals = conf["game"].get("traversable_neutrals",
                                                          False)
                 path = find_path(curr, dest, context.player.team,
-                                 traverse_neutrals=traverse_neutrals)
+                                 traverse_neutrals=traverse_neutrals,
+                                 fastest=True)
                 if path:
                     path = path[1:-1]  # We already have the first and the last
                     if not path:
@@ -568,16 +581,9 @@ class SkirmishCommand(Command):
                 # Create a top-level summary
                 details = "\n\n".join(skirmish.full_details(
                     config=context.config))
-                rname = context.reply(details, pm=False)
-                if rname:
-                    skirmish.summary_id = rname.name
-                else:
-                    # Couldn't reply, bail!
-                    context.session.rollback()
-                    context.reply("I'm sorry - an error occurred and "
-                                  "I coudn't commit your skirmish.  Disregard "
-                                  "the previous confirmation")
-                    return
+                context.reply(details, pm=False,
+                              callback="skirmish_summary",
+                              callback_id=skirmish.id)
             else:
                 # Update the top-level summary
                 SkirmishCommand.update_summary(context, skirmish)
@@ -692,50 +698,75 @@ class SkirmishCommand(Command):
         return parent
 
     @staticmethod
-    @failable
     def update_summary(context, skirmish):
-        root = skirmish.get_root()
-        if root.summary_id:
-            summary_ids = root.summary_id.split(",")
-            initial_id = summary_ids[0]
-            full_details = root.full_details(config=context.config)
-            summaries = []
-            partial_summary = StringIO()
-            for detail in full_details:
-                partial_summary.write(detail + "\n\n")
-                partial_summary.seek(0, os.SEEK_END)
-                if partial_summary.tell() > 9800:
-                    summaries.append(partial_summary)
-                    partial_summary = StringIO()
-            summaries.append(partial_summary)
-
-            tries = 0
-            while len(summaries) > len(summary_ids):
-                initial_post = context.reddit.get_info(thing_id=initial_id)
-                curr = summaries[len(summary_ids)]
-                summary = initial_post.reply(curr.getvalue())
-                if summary:
-                    summary_ids.append(summary.name)
-                    root.summary_id = ",".join(summary_ids)
-                else:
-                    tries = tries + 1
-                    if tries > 5:
-                        # Something seriously wrong, bail!
-                        context.session.rollback()
-                        context.reply("I'm sorry - an error occurred and "
-                            "I coudn't commit your skirmish.  Disregard "
-                            "the previous confirmation")
-                        return
+        """Note that the skirmish's summary needs refreshing
 
-            for index, partial in enumerate(summaries):
-                this_id = summary_ids[index]
-                if index < len(summaries) - 1:
-                    next_id = summary_ids[index + 1]
-                    tls = context.reddit.get_info(thing_id=next_id)
-                    partial.write("[Next](%s)" % tls.permalink)
-                tls = context.reddit.get_info(thing_id=this_id)
-                tls.edit(partial.getvalue())
-            context.session.commit()
+        Summaries are refreshed a batch at a time by refresh_summary, so a
+        burst of reactions costs one round of edits rather than one each.
+        """
+        skirmish.get_root().summary_dirty = True
+
+    @staticmethod
+    def summary_pages(context, root):
+        """Split the full details of a skirmish into comment-sized pages"""
+        pages = []
+        page = []
+        size = 0
+        for detail in root.full_details(config=context.config):
+            page.append(detail + "\n\n")
+            size += len(page[-1])
+            if size > 9800:
+                pages.append("".join(page))
+                page = []
+                size = 0
+        pages.append("".join(page))
+        return pages
+
+    @staticmethod
+    def refresh_summary(context, root):
+        """Queue edits for whichever summary pages have changed
+
+        Pages are compared against hashes of what we last queued for them,
+        so an unchanged page is never edited.  If the outbox gives up on an
+        edit, the hashes are forgotten and every page is queued again.
+        """
+        if not root.summary_id:
+            # Still in the outbox; we'll hear about it once it's posted
+            return
+        sess = context.session
+        summary_ids = root.summary_id.split(",")
+        pages = SkirmishCommand.summary_pages(context, root)
+
+        if len(pages) > len(summary_ids):
+            # Overflow pages are replies to the first, added one at a time.
+            # We stay dirty so the page before gets its link once it's up.
+            posting = (sess.query(OutboundMessage).
+                       filter_by(callback="summary_page",
+                                 callback_id=root.id).
+                       filter(OutboundMessage.next_attempt != None).count())
+            if not posting:
+                OutboundMessage.queue(sess, "reply", summary_ids[0],
+                                      pages[len(summary_ids)],
+                                      callback="summary_page",
+                                      callback_id=root.id)
+
+        battle = root.get_battle()
+        hashes = (root.summary_hashes or "").split(",")
+        hashes += [""] * (len(summary_ids) - len(hashes))
+        for index, this_id in enumerate(summary_ids[:len(pages)]):
+            text = pages[index]
+            if index + 1 < len(summary_ids) and index + 1 < len(pages):
+                text += "[Next](/r/%s/comments/%s/_/%s)" % (
+                    battle.region.srname, name_to_id(battle.submission_id),
+                    name_to_id(summary_ids[index + 1]))
+            digest = hashlib.md5(text.encode("utf-8")).hexdigest()
+            if hashes[index] != digest:
+                OutboundMessage.queue_edit(sess, this_id, text,
+                                           callback="summary_edit",
+                                           callback_id=root.id)
+                hashes[index] = digest
+        root.summary_hashes = ",".join(hashes)
+        root.summary_dirty = len(pages) > len(summary_ids)
 
 
 class StopCommand(Command):
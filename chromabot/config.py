@@ -4,6 +4,8 @@ import os.path
 
 import praw
 
+from pacing import PacedHandler
+
 
 class Config(object):
 
@@ -38,7 +40,8 @@ class Config(object):
         ua = self.data["bot"]["useragent"]
         site = self.data["bot"].get('site')
 
-        result = praw.Reddit(user_agent=ua, site_name=site)
+        result = praw.Reddit(user_agent=ua, site_name=site,
+                             handler=PacedHandler())
         return result
 
     def refresh(self):
@@ -50,6 +53,10 @@ class Config(object):
     def dbstring(self):
         return self.data["db"]["connection"]
 
+    @property
+    def sqlite_pragmas(self):
+        return self.data["db"].get("sqlite", {})
+
     @property
     def game(self):
         return self.data["game"]
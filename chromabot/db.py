@@ -2,26 +2,34 @@ import json
 import logging
 import random
 import time
+from contextlib import contextmanager
 
 from sqlalchemy import (
+    and_,
     create_engine,
+    event,
+    or_,
     Boolean,
     Column,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     Text,
 )
-from sqlalchemy.orm import backref, relationship, sessionmaker
+from sqlalchemy.orm import (backref, joinedload, relationship, sessionmaker,
+                            subqueryload)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import text
 
+import resolution
 import utils
-from pathfinder import find_path
 from utils import forcelist, name_to_id, now, num_to_team, pairwise
+from world import World
 
 
 # Some helpful model exceptions
@@ -136,10 +144,148 @@ class Model(object):
 Base = declarative_base(cls=Model)
 
 
+class ChromaSession(Session):
+    """A session that can batch a whole phase of work into one transaction
+
+    Model methods commit as they go, which suits the CLI and the tests but
+    costs the bot's main loop a disk sync per change.  Inside
+    unit_of_work(), commit() only flushes, and the real commit happens once
+    the outermost unit of work is done.
+
+    Anything that may need undoing on its own, like a single command, goes
+    in a savepoint().  While one is open, rollback() only undoes the work
+    done since it began.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Session.__init__(self, *args, **kwargs)
+        self.batching = 0
+        self.savepoints = 0
+        self.projections = {}  # Battle id -> resolution.Projection
+        self.projected = set()  # Battles projected since the last commit
+        self.codewords = {}  # User id -> {code: word}, see User.codeword_map
+        event.listen(self, "after_commit", self.projections_committed)
+        event.listen(self, "after_rollback", self.projections_rolled_back)
+        event.listen(self, "before_commit", self.world_committing)
+        event.listen(self, "after_commit", self.world_committed)
+        event.listen(self, "after_rollback", self.world_rolled_back)
+        event.listen(self, "after_rollback", self.codewords_rolled_back)
+
+    @contextmanager
+    def unit_of_work(self):
+        self.batching += 1
+        try:
+            yield self
+        except:
+            self.batching -= 1
+            if not self.batching:
+                Session.rollback(self)
+            raise
+        self.batching -= 1
+        if not self.batching:
+            Session.commit(self)
+
+    @contextmanager
+    def savepoint(self):
+        if not self.batching:
+            # Everything's committed as it goes anyway
+            yield self
+            return
+        self.begin_nested()
+        self.savepoints += 1
+        try:
+            yield self
+        except:
+            self.savepoints -= 1
+            Session.rollback(self)
+            raise
+        self.savepoints -= 1
+        Session.commit(self)  # Only releases the savepoint
+
+    def commit(self):
+        if self.batching:
+            self.flush()
+        else:
+            Session.commit(self)
+
+    def projections_committed(self, session):
+        if session.transaction.parent is None:
+            self.projected.clear()
+
+    def projections_rolled_back(self, session):
+        # The skirmishes they were told about may be gone; they'll be built
+        # again from scratch when next wanted
+        for battle_id in self.projected:
+            self.projections.pop(battle_id, None)
+        self.projected.clear()
+
+    def world_committing(self, session):
+        if session.transaction.parent is None:
+            # Battles coming and going only tell the World when flushed
+            self.flush()
+            world = World.of(self)
+            if world.uncommitted:
+                world.bump(self)
+
+    def world_committed(self, session):
+        if session.transaction.parent is None:
+            World.of(self).committed()
+
+    def world_rolled_back(self, session):
+        World.of(self).rolled_back()
+
+    def codewords_rolled_back(self, session):
+        self.codewords.clear()
+
+    def rollback(self):
+        Session.rollback(self)
+        if self.savepoints:
+            # That only undid the savepoint; start another in its place so
+            # whatever else happens in this block can still be undone
+            self.begin_nested()
+
+
 class DB(object):
+    # Applied to every new SQLite connection; the "sqlite" part of the db
+    # config can change any of these, or turn one off with null.  WAL lets
+    # readers like the CLI carry on while the bot writes, and "normal"
+    # syncing is still safe with it.
+    SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -20000,  # Negative means KiB, so 20MB
+        "mmap_size": 268435456,
+        "temp_store": "memory",
+        "busy_timeout": 5000,  # Milliseconds to wait for a lock
+    }
+
     def __init__(self, config):
         self.engine = create_engine(config.dbstring, echo=False)
-        self.sessionfactory = sessionmaker(bind=self.engine)
+        if self.engine.dialect.name == "sqlite":
+            self.pragmas = dict(self.SQLITE_PRAGMAS)
+            self.pragmas.update(getattr(config, "sqlite_pragmas", {}))
+            # pysqlite's own transaction handling breaks SAVEPOINT, so take
+            # it over as the SQLAlchemy docs suggest
+            event.listen(self.engine, "connect", self.sqlite_connect)
+            event.listen(self.engine, "begin", self.sqlite_begin)
+        self.sessionfactory = sessionmaker(bind=self.engine,
+                                           class_=ChromaSession,
+                                           info={"world": World()})
+
+    def sqlite_connect(self, dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in sorted(self.pragmas):
+            value = self.pragmas[pragma]
+            if pragma not in self.SQLITE_PRAGMAS:
+                logging.warning("Ignoring unknown pragma %s" % pragma)
+            elif value is not None:
+                cursor.execute("PRAGMA %s = %s" % (pragma, value))
+        cursor.close()
+
+    @staticmethod
+    def sqlite_begin(conn):
+        conn.execute("BEGIN")
 
     def create_all(self):
         Base.metadata.create_all(self.engine)
@@ -155,7 +301,7 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255))
+    name = Column(String(255), index=True, unique=True)
     team = Column(Integer)
     loyalists = Column(Integer)
     committed_loyalists = Column(Integer, default=0)
@@ -191,6 +337,7 @@ class User(Base):
             self.codewords.append(cw)
             s.add(cw)
         s.commit()
+        self.codeword_map()[code] = word
 
     def defect(self, team, conf=None):
         if team == self.team or team > 1:
@@ -271,7 +418,7 @@ class User(Base):
         for src, dest in pairwise(locations):
             if src == dest:
                 continue
-            if dest not in src.borders:
+            if not src.adjacent_to(dest):
                 raise NonAdjacentException(src, dest)
 
             traverse_neutrals = False
@@ -318,14 +465,33 @@ class User(Base):
         if cw:
             s.delete(cw)
             s.commit()
+            self.codeword_map().pop(cw.code, None)
+
+    def remove_all_codewords(self):
+        s = self.session()
+        for cw in list(self.codewords):
+            s.delete(cw)
+        s.commit()
+        self.codeword_map().clear()
+
+    def codeword_map(self):
+        """This player's codewords, as a dict of code -> word
+
+        Loaded once and then kept up to date by the methods that change
+        them, so translating a codeword doesn't need a query.
+        """
+        s = self.session()
+        cache = getattr(s, "codewords", {})
+        codewords = cache.get(self.id)
+        if codewords is None:
+            codewords = cache[self.id] = dict(
+                s.query(CodeWord.code, CodeWord.word).
+                filter_by(user_id=self.id))
+        return codewords
 
     def translate_codeword(self, code):
         code = code.strip().lower()
-        s = self.session()
-        cw = s.query(CodeWord).filter_by(code=code, user=self).first()
-        if cw:
-            return cw.word
-        return code
+        return self.codeword_map().get(code, code)
 
 region_to_region = Table("region_to_region", Base.metadata,
         Column("left_id", Integer, ForeignKey("regions.id"), primary_key=True),
@@ -337,10 +503,10 @@ class MarchingOrder(Base):
     __tablename__ = "marching_orders"
 
     id = Column(Integer, primary_key=True)
-    arrival = Column(Integer, default=0)
+    arrival = Column(Integer, default=0, index=True)
     dest_sector = Column(Integer, default=0)
 
-    leader_id = Column(Integer, ForeignKey('users.id'))
+    leader_id = Column(Integer, ForeignKey('users.id'), index=True)
     leader = relationship("User", backref="movement")
 
     # Relationships for these defined in the Region class
@@ -356,12 +522,50 @@ class MarchingOrder(Base):
 
     @classmethod
     def update_all(cls, sess, conf=None):
-        orders = sess.query(cls).all()
-        result = []
+        """Deal with every order that's arrived, all in one go
+
+        Orders are taken in the order they arrived, so a chain of them plays
+        out hop by hop.  Anyone whose next hop has become invalid has all
+        their orders cancelled at once, and the whole lot is committed
+        together.
+        """
+        cur = now()
+        orders = (sess.query(cls).filter(cls.arrival <= cur).
+                  options(joinedload("leader"), joinedload("dest")).
+                  order_by(cls.arrival, cls.id).all())
+        traverse_neutrals = False
+        if conf:
+            traverse_neutrals = conf["game"].get("traversable_neutrals", False)
+        world = World.of(sess)
+        location = {}  # Leader id -> region id, as of the orders so far
+        cancelled = set()
         for order in orders:
-            if order.update(conf=conf):
-                result.append(order)
-        return result
+            leader = order.leader
+            dest = order.dest
+            if leader.id in cancelled:
+                continue
+            here = location.get(leader.id, leader.region_id)
+            if (here == order.source_id and
+                    world.enterable_by(sess, dest.id, leader.team,
+                                       traverse_neutrals)):
+                leader.region = dest
+                leader.sector = order.dest_sector
+                location[leader.id] = dest.id
+                sess.delete(order)
+            else:
+                # Full stop!
+                cancelled.add(leader.id)
+        sess.flush()
+        stopped = list(cancelled)
+        for start in xrange(0, len(stopped), 500):
+            (sess.query(cls).
+             filter(cls.leader_id.in_(stopped[start:start + 500])).
+             delete(synchronize_session="fetch"))
+        for order in orders:
+            if order.leader_id in cancelled:
+                sess.expire(order.leader, ["movement"])
+        sess.commit()
+        return orders
 
     def has_arrived(self):
         now = time.mktime(time.localtime())
@@ -408,9 +612,9 @@ class Region(Base):
     __tablename__ = "regions"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255))
+    name = Column(String(255), index=True, unique=True)
     srname = Column(String(255))
-    capital = Column(Integer)
+    capital = Column(Integer, index=True)
     owner = Column(Integer)
     eternal = Column(Boolean)
     travel_multiplier = Column(Float, server_default=text('1.0'),
@@ -441,13 +645,10 @@ class Region(Base):
         sess = context.session
         if context.player:
             where = context.player.translate_codeword(where).lower()
-        dest = sess.query(cls).filter_by(name=where).first()
-        if not dest:
-            alias = sess.query(Alias).filter_by(
-                name=where
-            ).first()
-            if alias:
-                dest = alias.region
+        dest = None
+        region_id = World.of(sess).region_named(sess, where)
+        if region_id is not None:
+            dest = sess.query(cls).get(region_id)
         if require and not dest:
             context.reply(
                 "I don't know any region named '%s'" %
@@ -457,7 +658,9 @@ class Region(Base):
 
     @classmethod
     def capital_for(cls, team, session):
-        return session.query(cls).filter_by(capital=team).first()
+        capital = World.of(session).capital(session, team)
+        if capital is not None:
+            return session.query(cls).get(capital)
 
     @classmethod
     def create_from_json(cls, session, json_str=None, json_file=None):
@@ -475,6 +678,7 @@ class Region(Base):
             session.add(created)
             created.alias_from_dict(region)
             atlas[created.name] = created
+        World.of(session).names_changed()
 
         # Hook up the regions
         for region in unconverted:
@@ -535,6 +739,7 @@ class Region(Base):
                     print "Creating region %s" % region["name"]
                 r = cls.from_dict(region)
                 session.add(r)
+                World.of(session).names_changed()
             # Also aliases
             r.alias_from_dict(region)
 
@@ -558,9 +763,9 @@ class Region(Base):
     def update_all(cls, sess, config):
         """Check for eternal battles that should be happening in the region"""
         battles = []
-        regions = sess.query(cls).all()
+        regions = sess.query(cls).filter_by(eternal=True).all()
         for region in regions:
-            if region.eternal and not region.battle:
+            if not region.battle:
                 begins = now() + config['game']['battle_delay']
                 newbattle = region.new_battle_here(begins, autocommit=False)
                 battles.append(newbattle)
@@ -576,10 +781,17 @@ class Region(Base):
         # just going to do it manually
         self.borders.append(other_region)
         other_region.borders.append(self)
+        self.borders_changed()
 
     def remove_border(self, other_region):
         self.borders.remove(other_region)
         other_region.borders.remove(self)
+        self.borders_changed()
+
+    def borders_changed(self):
+        sess = self.session()
+        if sess:
+            World.of(sess).borders_changed()
 
     def buff_with(self, buff):
         # Comitted the cardinal sin of copy-pasting this from SkirmishAction
@@ -595,10 +807,14 @@ class Region(Base):
         s = self.session()
         return s.query(Buff).filter_by(internal=buffname).first()
 
+    def adjacent_to(self, other_region):
+        sess = self.session()
+        return World.of(sess).adjacent(sess, self.id, other_region.id)
+
     def enterable_by(self, team, traverse_neutrals=False):
-        if self.owner is None and traverse_neutrals:
-            return True
-        return self.owner == team or self.battle
+        sess = self.session()
+        return World.of(sess).enterable_by(sess, self.id, team,
+                                           traverse_neutrals)
 
     def invade(self, by_who, when):
         if not by_who.leader:
@@ -607,14 +823,16 @@ class Region(Base):
         if self.owner == by_who.team:
             raise TeamException(self, friendly=True)
 
-        if self.battle:
+        sess = self.session()
+        world = World.of(sess)
+        if world.has_battle(sess, self.id):
             raise InProgressException(self.battle)
 
         # Make sure that the given team owns at least one region adjacent
         # to this one
-        bad_neighbors = [region for region in self.borders
-                         if region.owner is not None
-                            and region.owner == by_who.team]
+        neighbors = world.adjacency(sess).get(self.id, ())
+        bad_neighbors = [region for region in neighbors
+                         if world.owner(sess, region) == by_who.team]
         if not bad_neighbors:
             raise NonAdjacentException(self, "your territory")
 
@@ -653,6 +871,7 @@ class Region(Base):
 
         a = Alias(name=name, region=self)
         s.add(a)
+        World.of(s).names_changed()
         s.commit()
         return a
 
@@ -668,10 +887,10 @@ class Battle(Base):
     __tablename__ = "battles"
 
     id = Column(Integer, primary_key=True)
-    begins = Column(Integer, default=0)
-    ends = Column(Integer, default=0)
+    begins = Column(Integer, default=0, index=True)
+    ends = Column(Integer, default=0, index=True)
     display_ends = Column(Integer, default=0)
-    submission_id = Column(String)
+    submission_id = Column(String, index=True)
 
     victor = Column(Integer)
     score0 = Column(Integer)
@@ -682,25 +901,60 @@ class Battle(Base):
 
     lockout = Column(Integer, default=0)
 
+    @classmethod
+    def started(cls, cur):
+        """SQL for has_started(), as of cur"""
+        return and_(cls.begins <= cur,
+                    cls.submission_id != None, cls.submission_id != "",
+                    cls.ends >= cls.begins)
+
     @classmethod
     def update_all(cls, sess, conf=None):
-        battles = sess.query(cls).all()
-        begin = []
-        ended = []
-        skirmish_ended = []
-        for battle in battles:
-            if not battle.has_started() and battle.is_ready():
-                begin.append(battle)
-            elif battle.has_started() and battle.past_end_time():
-                battle.resolve(conf)
-                ended.append(battle)
-            elif battle.has_started():
-                skirmish_ended.extend(battle.update())
+        """Move along every battle and skirmish whose time has come
+
+        Rather than loading every battle to ask, each kind of change is its
+        own query on the time columns, so only what's actually changing gets
+        loaded.
+        """
+        cur = now()
+        # Ready, but not started yet.  Battles whose threads haven't been
+        # posted have to wait for them.
+        begin = (sess.query(cls).
+                 filter(cls.begins <= cur).
+                 filter(cls.submission_id != None).
+                 filter(cls.submission_id != "").
+                 filter(or_(cls.ends == None, cls.ends < cls.begins)).
+                 order_by(cls.id).all())
+
+        ended = (sess.query(cls).
+                 filter(cls.ends <= cur).
+                 filter(cls.started(cur)).
+                 order_by(cls.id).all())
+
+        # Skirmishes ending in battles that are going to keep going
+        due = (sess.query(SkirmishAction).
+               join(cls, SkirmishAction.battle_id == cls.id).
+               filter(SkirmishAction.parent_id == None).
+               filter(or_(SkirmishAction.resolved == None,
+                          SkirmishAction.resolved == False)).
+               filter(SkirmishAction.ends > 0).
+               filter(SkirmishAction.ends <= cur).
+               filter(cls.ends > cur).
+               filter(cls.started(cur)).
+               order_by(SkirmishAction.id).all())
+
+        for battle in ended:
+            battle.resolve(conf)
+
+        if due:
+            SkirmishAction.load(sess.query(SkirmishAction).filter(
+                SkirmishAction.root_id.in_([s.id for s in due])))
+            SkirmishAction.resolve_all(due)
 
         result = {
             "begin": begin,
             "ended": ended,
-            "skirmish_ended": skirmish_ended
+            "skirmish_ended": due
         }
         return result
 
@@ -755,6 +1009,56 @@ class Battle(Base):
     def participants(self):
         return {skirmish.participant for skirmish in self.skirmishes}
 
+    def projection(self):
+        """How this battle would come out if it ended right now
+
+        Built once from a full resolution, and then kept up to date by
+        project() as skirmishes are added.  Nothing's written back to the
+        skirmishes themselves.
+        """
+        projections = getattr(self.session(), "projections", {})
+        projection = projections.get(self.id)
+        if projection is None:
+            self.load_skirmishes()
+            forest, nodes = SkirmishAction.flatten(self.toplevel_skirmishes())
+            sectors = dict((index, node.sector)
+                           for index, node in enumerate(nodes)
+                           if forest.toplevel[index])
+            projection = resolution.Projection(
+                forest, [node.id for node in nodes], sectors)
+            projections[self.id] = projection
+        return projection
+
+    def project(self, skirmish):
+        """Bring our projection up to date with a new or changed skirmish"""
+        sess = self.session()
+        projection = getattr(sess, "projections", {}).get(self.id)
+        if projection is None:
+            return  # Nobody's asked for one yet
+        buffs = [buff.value for buff in skirmish.buffs]
+        if skirmish.id in projection.index:
+            projection.rebuff(skirmish.id, buffs)
+        else:
+            projection.add(skirmish.id, skirmish.amount, skirmish.hinder,
+                           skirmish.troop_type, skirmish.participant.team,
+                           buffs, skirmish.parent_id, skirmish.sector)
+        sess.projected.add(self.id)
+
+    def projected_report(self, config=None):
+        projection = self.projection()
+        totals = projection.totals()
+        result = ["## Projected Score",
+                  "If the battle ended now, before any buffs:",
+                  "* Team %s: %d" % (num_to_team(0, config), totals[0]),
+                  "* Team %s: %d" % (num_to_team(1, config), totals[1])]
+        if len(projection.score) > 1:
+            result.append("")
+            for sector, score in sorted(projection.score.items()):
+                result.append("* Sector %d - Team %s: %d, Team %s: %d" % (
+                    sector, num_to_team(0, config), score[0],
+                    num_to_team(1, config), score[1]))
+        return result
+
     def past_end_time(self):
         now = time.mktime(time.localtime())
         return now >= self.ends
@@ -773,8 +1077,11 @@ class Battle(Base):
 
         score = [[0, 0] for _ in xrange(num_sectors + 1)]
 
-        for skirmish in self.toplevel_skirmishes():
-            skirmish.resolve()
+        self.load_skirmishes()
+        toplevel = self.toplevel_skirmishes()
+        SkirmishAction.resolve_all(toplevel)
+        getattr(self.session(), "projections", {}).pop(self.id, None)
+        for skirmish in toplevel:
             if skirmish.victor is not None:
                 score[skirmish.sector][skirmish.victor] += skirmish.vp
 
@@ -792,18 +1099,17 @@ class Battle(Base):
         if conf and conf["game"].get("homeland_defense"):
             percents = [int(amount) / 100.0 for amount in
                         conf["game"]["homeland_defense"].split("/")]
-            for score_per_sector in score:
-                # Ephemeral, for reporting
-                for team in range(0, 2):
-                    self.homeland_buffs.append(0)
-                    cap = Region.capital_for(team, self.session())
-                    path = find_path(cap, self.region)
-                    if path:
-                        dist = len(path) - 1
-                        if dist < len(percents):
-                            self.homeland_buffs[team] = percents[dist] * 100
-                            score_per_sector[team] += int(
-                                score_per_sector[team] * percents[dist])
+            world = World.of(self.session())
+            # Ephemeral, for reporting
+            self.homeland_buffs = [0, 0]
+            for team in range(0, 2):
+                dist = world.capital_distance(self.session(), team,
+                                              self.region.id)
+                if dist is not None and dist < len(percents):
+                    self.homeland_buffs[team] = percents[dist] * 100
+                    for score_per_sector in score:
+                        score_per_sector[team] += int(
+                            score_per_sector[team] * percents[dist])
 
         final_score = [0, 0]
         sector_wins = [0, 0]
@@ -902,9 +1208,23 @@ class Battle(Base):
     def toplevel_skirmishes(self):
         return [s for s in self.skirmishes if s.parent is None]
 
+    def load_skirmishes(self):
+        """Load every skirmish in this battle, linked into their trees
+
+        Walking the trees otherwise lazy-loads each skirmish's children,
+        buffs and participant one at a time; this does it all in two
+        queries, however big the battle.
+        """
+        sess = self.session()
+        skirmishes = SkirmishAction.load(
+            sess.query(SkirmishAction).filter_by(battle_id=self.id))
+        set_committed_value(self, "skirmishes", skirmishes)
+        return skirmishes
+
     def update(self):
         """Update the skirmishes in this battle"""
         ended = []
+        self.load_skirmishes()
         for s in self.toplevel_skirmishes():
             if s.update():
                 ended.append(s)
@@ -916,6 +1236,9 @@ class Battle(Base):
 
 class CodeWord(Base):
     __tablename__ = 'codewords'
+    __table_args__ = (
+        Index('ix_codewords_user_id_code', 'user_id', 'code', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     code = Column(String(255))
@@ -933,7 +1256,7 @@ class Alias(Base):
     __tablename__ = 'aliases'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255))
+    name = Column(String(255), index=True, unique=True)
 
     region_id = Column(Integer, ForeignKey("regions.id"))
     region = relationship("Region", backref="aliases")
@@ -942,13 +1265,123 @@ class Alias(Base):
         return "<Alias(name='%s')>" % self.name
 
 
+class Cursor(Base):
+    """A bookmark for how far we've read through some reddit listing"""
+    __tablename__ = "cursors"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255))
+    position = Column(String(255))  # Fullname of the newest thing we've read
+
+    @classmethod
+    def named(cls, sess, name):
+        found = sess.query(cls).filter_by(name=name).first()
+        if not found:
+            found = cls(name=name)
+            sess.add(found)
+        return found
+
+    def __repr__(self):
+        return "<Cursor(name='%s', position='%s')>" % (self.name,
+                                                       self.position)
+
+
+class WorldVersion(Base):
+    """How many times the map has changed, across every process
+
+    Whenever a session commits a change to what the World keeps in memory,
+    it bumps this, so that a World in another process (the bot's, when the
+    CLI or a patch changes things) can tell it's out of date.
+    """
+    __tablename__ = "world_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+
+
+class OutboundMessage(Base):
+    """Something we've said that hasn't made it to reddit yet
+
+    Replies, PMs and new threads wait here until the bot's outbox task
+    sends them, so commands never wait on reddit and a send that fails is
+    tried again later rather than lost.
+    """
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16))  # "pm", "reply", "submit" or "edit"
+    # A username, the fullname being replied to or edited, or a subreddit
+    recipient = Column(String(255))
+    subject = Column(String(255))  # For PMs and threads
+    body = Column(String)
+    queued = Column(Integer, default=now)
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(Integer, default=0)  # None once we've given up
+    last_error = Column(String)
+
+    # Who to tell the fullname of what we posted, e.g. "battle_submission"
+    callback = Column(String(255))
+    callback_id = Column(Integer)
+
+    @classmethod
+    def queue(cls, sess, kind, recipient, body, subject=None, callback=None,
+              callback_id=None):
+        msg = cls(kind=kind, recipient=recipient, body=body, subject=subject,
+                  callback=callback, callback_id=callback_id)
+        sess.add(msg)
+        return msg
+
+    @classmethod
+    def queue_edit(cls, sess, fullname, body, callback=None,
+                   callback_id=None):
+        """Queue an edit, replacing any unsent one of the same thing"""
+        pending = (sess.query(cls).
+                   filter_by(kind="edit", recipient=fullname).
+                   filter(cls.next_attempt != None).first())
+        if pending:
+            pending.body = body
+            return pending
+        return cls.queue(sess, "edit", fullname, body, callback=callback,
+                         callback_id=callback_id)
+
+    @classmethod
+    def ready(cls, sess, limit=None):
+        """Messages due to be sent, oldest first"""
+        q = (sess.query(cls).filter(cls.next_attempt <= now()).
+             order_by(cls.id))
+        if limit:
+            q = q.limit(limit)
+        return q.all()
+
+    def failed(self, error, config):
+        """Note a failed send and back off before the next one
+
+        Returns False if we've now tried too many times and are giving up.
+        """
+        bot = config["bot"]
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= bot.get("outbox_attempts", 10):
+            self.next_attempt = None
+            return False
+        delay = bot.get("outbox_backoff", 30) * 2 ** (self.attempts - 1)
+        self.next_attempt = now() + min(delay,
+                                        bot.get("outbox_max_backoff", 3600))
+        return True
+
+    def __repr__(self):
+        return "<OutboundMessage(id='%s', kind='%s', recipient='%s')>" % (
+            self.id, self.kind, self.recipient)
+
+
 class Processed(Base):
     __tablename__ = "processed"
 
     id = Column(Integer, primary_key=True)
-    id36 = Column(String)  # Actually a fullname (can be a message or comment)
+    # Actually a fullname (can be a message or comment)
+    id36 = Column(String, index=True, unique=True)
 
-    battle_id = Column(Integer, ForeignKey('battles.id'))
+    battle_id = Column(Integer, ForeignKey('battles.id'), index=True)
     battle = relationship("Battle",
                           backref=backref("processed_comments",
                                           cascade="all, delete"))
@@ -960,13 +1393,15 @@ class SkirmishAction(Base):
     TROOP_TYPES = ['infantry', 'cavalry', 'ranged']
 
     id = Column(Integer, primary_key=True)
-    comment_id = Column(String)
+    comment_id = Column(String, index=True)
     summary_id = Column(String)
+    summary_hashes = Column(String)  # Of each summary page, as last queued
+    summary_dirty = Column(Boolean, default=False)
     amount = Column(Integer, default=0)
     hinder = Column(Boolean, default=True)
     resolved = Column(Boolean, default=False)
     troop_type = Column(String, default='infantry')
-    ends = Column(Integer, default=0)
+    ends = Column(Integer, default=0, index=True)
     display_ends = Column(Integer, default=0)
     sector = Column(Integer, default=0)
 
@@ -975,18 +1410,23 @@ class SkirmishAction(Base):
     margin = Column(Integer)
     unopposed = Column(Boolean, default=False)
 
-    battle_id = Column(Integer, ForeignKey('battles.id'))
+    battle_id = Column(Integer, ForeignKey('battles.id'), index=True)
     battle = relationship("Battle",
                           backref=backref("skirmishes",
                                           cascade="all, delete"))
 
-    participant_id = Column(Integer, ForeignKey('users.id'))
+    participant_id = Column(Integer, ForeignKey('users.id'), index=True)
     participant = relationship("User", backref="skirmishes")
 
-    parent_id = Column(Integer, ForeignKey('skirmish_actions.id'))
+    parent_id = Column(Integer, ForeignKey('skirmish_actions.id'),
+                       index=True)
     children = relationship("SkirmishAction",
         backref=backref('parent', remote_side=[id],
                         cascade="all, delete"))
+    # Kept alongside parent_id so the root's a single lookup; roots are
+    # their own root
+    root_id = Column(Integer, index=True)
+    depth = Column(Integer, default=0)
 
     @classmethod
     def create(cls, sess, who, howmany, hinder=True, parent=None, battle=None,
@@ -1009,33 +1449,28 @@ class SkirmishAction(Base):
                             ends=ends,
                             display_ends=display_ends,
                             sector=sector)
+        if parent:
+            sa.root_id = parent.get_root().id
+            sa.depth = (parent.depth or 0) + 1
         # Ephemeral, only want it to exist for long enough to pass validation
         sa.enforce_noob_rule = enforce_noob_rule
         sa.commit_if_valid()
+        if not parent:
+            sa.root_id = sa.id
+            sess.commit()
+        if battle:
+            battle.project(sa)
 
         return sa
 
     def adjusted_for_buffs(self):
-        amount = self.amount
-        for buff in self.buffs:
-            amount += (buff.value * amount)
-        return int(amount)
+        return resolution.buffed(self.amount,
+                                 [buff.value for buff in self.buffs])
 
     def adjusted_for_type(self, other_type, amount, support=False):
         """Certain types will be more effective vs. this skirmish"""
-        if support:
-            ordering = ["cavalry", "infantry", "ranged"]
-        else:
-            ordering = ["ranged", "infantry", "cavalry"]
-        our_index = ordering.index(self.troop_type)
-        penalty = ordering[our_index - 1]
-        bonus = ordering[(our_index + 1) % len(ordering)]
-        result = amount
-        if other_type == penalty:
-            result = int(amount / 2)
-        elif other_type == bonus:
-            result = int(amount * 1.5)
-        return result
+        return resolution.type_adjusted(self.troop_type, other_type, amount,
+                                        support)
 
     def buff_with(self, buff):
         # Hold on, do we already have this buff?
@@ -1046,25 +1481,59 @@ class SkirmishAction(Base):
         self.buffs.append(buff)
         self.session().add(buff)
         self.session().commit()
+        battle = self.get_battle()
+        if battle:
+            battle.project(self)
 
     def get_battle(self):
         """
         Returns the battle that this skirmish belongs to - if this is a
         child skirmish, will go up the chain to the root
         """
-        if self.parent:
-            return self.get_root().get_battle()
-        else:
-            return self.battle
+        return self.get_root().battle
 
     def get_root(self):
         """
         Returns the root of this skirmish, which may be itself
         """
-        if self.parent:
-            return self.parent.get_root()
-        else:
-            return self
+        sess = self.session()
+        if self.root_id is not None and sess:
+            if self.root_id == self.id:
+                return self
+            # Usually already in the session, so no query at all
+            return sess.query(SkirmishAction).get(self.root_id)
+        # Not saved yet; walk up, but without recursing
+        root = self
+        while root.parent:
+            root = root.parent
+        return root
+
+    @classmethod
+    def load(cls, query):
+        """Run a query for whole skirmish trees and link them together
+
+        Participants and buffs come along too, so walking the trees
+        afterwards needs no further queries.
+        """
+        skirmishes = (query.options(joinedload("participant"),
+                                    subqueryload("buffs")).
+                      order_by(SkirmishAction.id).all())
+        by_id = dict((s.id, s) for s in skirmishes)
+        children = dict((s.id, []) for s in skirmishes)
+        for s in skirmishes:
+            if s.parent_id in children:
+                children[s.parent_id].append(s)
+        for s in skirmishes:
+            set_committed_value(s, "children", children[s.id])
+            set_committed_value(s, "parent", by_id.get(s.parent_id))
+        return skirmishes
+
+    def load_tree(self):
+        """Load this skirmish's whole tree, and return its root"""
+        root = self.get_root()
+        SkirmishAction.load(self.session().query(SkirmishAction).
+                            filter_by(root_id=root.id))
+        return root
 
     @property
     def is_root(self):
@@ -1081,75 +1550,57 @@ class SkirmishAction(Base):
         return sa
 
     def resolve(self):
-        # Make a results representing us
-        self.victor = self.participant.team
-        self.vp = 0
-        self.margin = self.adjusted_for_buffs()
-        cap = self.margin
-        self.unopposed = True
-
-        # Resolve our children, if any
-        if self.children:
-            supporters = [child.resolve() for child in self.children
-                          if child.hinder == False]
-            raw_support = self.amount
-            support = self.margin
-            attack = 0
-            raw_attack = attack
-            for supporter in supporters:
-                if supporter.victor == self.participant.team:
-                    # Support only counts if it didn't get ambushed on the way
-                    amount = supporter.margin
-                    raw_support += amount
-                    support += self.adjusted_for_type(supporter.troop_type,
-                                                      amount,
-                                                      support=True)
-                # If the attackers overtook this support, we do nothing;
-                # attacks don't carry beyond their immediate target
-
-            attackers = [child.resolve() for child in self.children
-                         if child.hinder == True]
-            for attacker in attackers:
-                if attacker.victor != self.participant.team:
-                    # Attackers only count if they weren't beaten by our team
-                    amount = attacker.margin
-                    raw_attack += amount
-                    attack += self.adjusted_for_type(attacker.troop_type,
-                                                     amount)
-
-            self.unopposed = attack == 0
-
-            if attack > support:
-                # This skirmish loses!
-                self.margin = attack - support
-                self.victor = [1, 0][self.participant.team]
-                self.vp += raw_support
-            elif support > attack:
-                # This skirmish wins!
-                self.margin = support - attack
-                self.victor = self.participant.team
-                self.vp += raw_attack
-            else:
-                # Nobody is the winner, but this skirmish is sure the loser
-                self.victor = None
-                self.margin = 0
-                self.vp += max(raw_attack, raw_support)
-        # Support nodes can't supply more than their initial numbers
-        if not self.hinder:
-            self.margin = min(self.margin, cap)
-        if not self.parent:
-            # The VP of a root node is the sum of all the children's VP
-            # for the team that won
-            # Note that because `vp_for_team` includes self.vp, this is
-            # effectively a +=
-            self.vp = self.vp_for_team(self.victor)
-            # Unopposed root nodes are worth 2x VP
-            if self.unopposed:
-                self.vp = max(self.vp * 2, self.amount * 2)
-
-        self.resolved = True
-        self.session().commit()
-        return self
+        """Resolve this skirmish and everything under it"""
+        return SkirmishAction.resolve_all([self])[0]
+
+    @classmethod
+    def resolve_all(cls, skirmishes):
+        """Resolve the given skirmishes and everything under them
+
+        The trees are flattened for the resolution module to work out, and
+        the results written back in one go.
+        """
+        forest, nodes = cls.flatten(skirmishes)
+        results = resolution.resolve(forest)
+        for index, node in enumerate(nodes):
+            node.victor = results.victor[index]
+            node.margin = results.margin[index]
+            node.vp = results.vp[index]
+            node.unopposed = results.unopposed[index]
+            node.resolved = True
+        if nodes:
+            nodes[0].session().commit()
+        return skirmishes
+
+    @classmethod
+    def flatten(cls, skirmishes):
+        """The given skirmishes' trees as a resolution.Forest
+
+        Also returns the skirmishes themselves, in the forest's order.
+        """
+        forest = resolution.Forest()
+        nodes = []
+        parents = []  # Of each node, for once we know everyone's index
+        index_of = {}
+        # Post-order without recursion, as reaction chains can get deep
+        stack = [(top, None, False) for top in reversed(skirmishes)]
+        while stack:
+            node, parent, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, parent, True))
+                for child in reversed(node.children):
+                    stack.append((child, node, False))
+                continue
+            index_of[node.id] = forest.add(
+                node.amount, node.hinder, node.troop_type,
+                node.participant.team, [buff.value for buff in node.buffs],
+                toplevel=parent is None and node.parent is None)
+            nodes.append(node)
+            parents.append(parent)
+        for index, parent in enumerate(parents):
+            if parent is not None:
+                forest.parent[index] = index_of[parent.id]
+        return forest, nodes
 
     def vp_for_team(self, team):
         """The VP that this skirmish provides for the given team"""
@@ -1367,7 +1818,7 @@ class Buff(Base):
     name = Column(String, default='buff')
     internal = Column(String, default='buff')
     value = Column(Float, default=0)
-    expires = Column(Integer, default=0)
+    expires = Column(Integer, default=0, index=True)
 
     skirmish_id = Column(Integer, ForeignKey('skirmish_actions.id'))
     skirmish = relationship("SkirmishAction",
@@ -1408,13 +1859,16 @@ class Buff(Base):
     # Ordinary class methods
     @classmethod
     def update_all(cls, sess):
-        expired = []
-        for buff in sess.query(cls).all():
-            if buff.expires and now() > buff.expires:
-                expired.append(buff)
-
-        for buff in expired:
-            sess.delete(buff)
+        """Delete every expired buff with a single statement"""
+        expired = (sess.query(cls).
+                   filter(cls.expires > 0).
+                   filter(cls.expires < now()))
+        if expired.delete(synchronize_session="fetch"):
+            # Anything already holding its buffs needs to look again
+            for obj in sess.identity_map.values():
+                if (isinstance(obj, (Region, SkirmishAction)) and
+                        "buffs" in obj.__dict__):
+                    sess.expire(obj, ["buffs"])
         sess.commit()
 
     def markdown(self):
@@ -1425,6 +1879,25 @@ class Buff(Base):
         return"<Buff(internal='%s')>" % self.internal
 
 
+def region_changed_hands(region, value, oldvalue, initiator):
+    sess = Session.object_session(region)
+    if sess and value != oldvalue:
+        World.of(sess).ownership_changed()
+
+
+def battle_came_or_went(mapper, connection, battle):
+    sess = Session.object_session(battle)
+    if sess:
+        World.of(sess).ownership_changed()
+
+
+# Who can go where depends on these, so the World needs to know
+event.listen(Region.owner, "set", region_changed_hands)
+event.listen(Region.travel_multiplier, "set", region_changed_hands)
+event.listen(Battle, "after_insert", battle_came_or_went)
+event.listen(Battle, "after_delete", battle_came_or_went)
+
+
 class TeamInfo(Base):
     __tablename__ = 'team_info'
 
@@ -0,0 +1,55 @@
+from praw.helpers import flatten_tree
+from praw.objects import MoreComments
+
+
+class CommentExpander(object):
+    """Expands the "load more comments" parts of threads a bit at a time
+
+    Expanding a MoreComments costs an API request, and a big enough thread
+    has hundreds of them.  Rather than expanding them all in one go, this
+    spends a limited number of requests per thread per loop and remembers
+    which comments from each thread have been dealt with, so the next loop
+    only spends requests on the parts that are still unread.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget  # Requests per loop; None means no limit
+        self.read = {}  # Submission fullname -> fullnames of comments read
+
+    def share(self, how_many):
+        """Each thread's share of the budget when reading `how_many`"""
+        if self.budget is None:
+            return None
+        return max(1, self.budget / max(how_many, 1))
+
+    def expand(self, post, limit=None):
+        """Expand up to `limit` of the post's MoreComments
+
+        Returns True if the post's comment tree is now complete.  As with
+        praw's replace_more_comments, any unexpanded MoreComments are
+        removed from the tree afterwards.
+        """
+        read = self.read.get(post.fullname, ())
+        for item in flatten_tree(post.comments):
+            if isinstance(item, MoreComments):
+                # Don't spend a request on what we've read before; a
+                # MoreComments left with no children is skipped for free
+                item.children = [child for child in item.children
+                                 if "t1_%s" % child not in read]
+
+        unexpanded = post.replace_more_comments(limit=limit, threshold=0)
+        return not [more for more in unexpanded if more.children]
+
+    def mark_read(self, fullname, names):
+        """Remember that the given comments from a thread are dealt with
+
+        Only call this once whatever was done about them is committed;
+        comments that aren't marked will be expanded again next time.
+        """
+        self.read.setdefault(fullname, set()).update(names)
+
+    def forget_except(self, fullnames):
+        """Stop remembering threads other than the given ones"""
+        for fullname in self.read.keys():
+            if fullname not in fullnames:
+                del self.read[fullname]
@@ -4,18 +4,29 @@ import logging
 import os.path
 import random
 import time
+from collections import defaultdict, deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from urllib import urlencode
 
 import praw
-from praw.errors import NotFound
+from praw.errors import NotFound, RateLimitExceeded
 from pyparsing import ParseException
+from sqlalchemy import event
 
 import db
 from config import Config
-from db import DB, Battle, Region, User, MarchingOrder, Processed, TeamInfo
+from expander import CommentExpander
+from metrics import Metrics
+from db import (DB, Battle, Cursor, Region, User, MarchingOrder,
+                OutboundMessage, Processed, SkirmishAction, TeamInfo)
 from parser import parse
+from runtime import Runtime, Task
+from scheduler import Scheduler
+from seen import SeenCache
+from world import World
 from commands import (Command, Context, failable, InvadeCommand,
-                      SkirmishCommand, StatusCommand)
+                      REDDIT_ERRORS, SkirmishCommand, StatusCommand)
 from utils import (base36decode, extract_command, num_to_team, name_to_id, now,
                    timestr, version)
 
@@ -27,39 +38,246 @@ class Bot(object):
         self.db = DB(config)
         self.db.create_all()
         self.session = self.db.session()
+        self.scheduler = Scheduler(self.session)
+        self.seen = SeenCache(self.session)
+        self.metrics = Metrics(config["bot"].get("metrics_window", 100))
+        self.metrics.watch_engine(self.db.engine)
+        self.metrics.watch_reddit(reddit)
+        # Fetching is network-bound, so threads are fine despite the GIL.
+        # Only the fetching happens there; the session stays on this thread.
+        self.pool = ThreadPool(config["bot"].get("fetch_threads", 4))
+        # Requests per loop to spend on "load more comments"
+        budget = config["bot"].get("expand_budget", 64)
+        self.battle_expander = CommentExpander(budget)
+        self.recruit_expander = CommentExpander(budget)
+        # (expander, thread, comments) to mark read once they're committed
+        self.reading = []
+        # Messages dealt with, to be marked read by the next fetch once
+        # they're committed; the fetch runs on another thread, hence a deque
+        self.answered = []
+        self.answered_committed = deque()
+        event.listen(self.session, "after_commit", self.reading_committed)
+        event.listen(self.session, "after_rollback",
+                     self.reading_rolled_back)
+        # New comments and messages seen, for deciding how often to look
+        self.activity = 0
+        self.idle_sleep = {}  # Task name -> (its interval, activity then)
+        # Don't send anything before this; reddit says we're posting too fast
+        self.outbox_resume = 0
+        # What became of each message, as soon as it's sent; kept here rather
+        # than returned, so a send that fails partway still gets recorded
+        self.outbox_sent = deque()
+        # Battle id -> what we last put in its post while it was underway
+        self.battle_posts = {}
+        self.runtime = None
 
     @failable
-    def check_battles(self):
+    def prepare_battles(self):
+        """Work out which threads and listings need reading for battles"""
         session = self.session
-        battles = session.query(Battle).all()
-        for battle in battles:
-            post = self.reddit.get_submission(
-                comment_limit=None,
-                submission_id=name_to_id(battle.submission_id))
-            if post:
+        # Battles whose threads are still in the outbox have nothing to read
+        battles = (session.query(Battle).
+                   filter(Battle.submission_id != None).all())
+        self.battle_expander.forget_except(
+            set(battle.submission_id for battle in battles))
+        self.seen.forget_except(set(battle.id for battle in battles))
+        threads = []
+        streams = []
+        if self.config["bot"].get("battle_source") == "stream":
+            # Most maps hold every battle in the same subreddit, so reading
+            # only what's new there is far cheaper than re-reading every
+            # thread.
+            by_sub = defaultdict(list)
+            for battle in battles:
+                by_sub[battle.region.srname].append(
+                    (battle.id, battle.submission_id))
+            for srname, sub_battles in by_sub.items():
+                cursor = Cursor.named(session, "comments/%s" % srname)
+                streams.append((srname, cursor.position, sub_battles))
+        else:
+            threads = [(battle.id, battle.submission_id)
+                       for battle in battles]
+        return threads, streams
+
+    def fetch_battles(self, prepared):
+        """Download everything prepare_battles asked for
+
+        If we have no idea where a subreddit's listing left off, or more
+        has happened than the listing can show us, its battles' threads are
+        read in full instead.
+        """
+        if not prepared:
+            return None
+        threads, streams = prepared
+        fetch = self.metrics.bind(self.fetch_new_comments)
+        listings = [(srname, sub_battles,
+                     self.pool.apply_async(fetch, (srname, position)))
+                    for srname, position, sub_battles in streams]
+        posts = self.fetch_battle_threads(threads)
+
+        fetched_streams = []
+        for srname, sub_battles, listing in listings:
+            fetched = listing.get()
+            if fetched is None:
+                continue  # Reddit trouble; the cursor stays put for next time
+            comments, caught_up = fetched
+            sub_posts = None
+            if not caught_up:
+                sub_posts = self.fetch_battle_threads(sub_battles)
+            fetched_streams.append((srname, sub_battles, comments, sub_posts))
+        return posts, fetched_streams
+
+    def fetch_battle_threads(self, battles):
+        """Download the given (battle id, submission id)s' threads at once"""
+        limit = self.battle_expander.share(len(battles))
+        fetch = self.metrics.bind(self.fetch_battle_post)
+        fetches = [(battle_id, self.pool.apply_async(fetch,
+                                                     (submission_id, limit)))
+                   for battle_id, submission_id in battles]
+        return [(battle_id, fetch.get()) for battle_id, fetch in fetches]
+
+    @failable
+    def fetch_battle_post(self, submission_id, limit=None):
+        """Download a battle thread's comment tree
+
+        Spends at most `limit` requests expanding it, and returns the post
+        along with whether its tree is complete.
+        """
+        post = self.reddit.get_submission(
+            comment_limit=None,
+            submission_id=name_to_id(submission_id))
+        if post:
+            complete = self.battle_expander.expand(post, limit)
+            if not complete:
+                logging.info("Thread %s will take more than one loop "
+                             "to expand" % submission_id)
+            return post, complete
+
+    @failable
+    def fetch_new_comments(self, srname, position):
+        """Download a subreddit's comments newer than the given fullname
+
+        Returns the comments (newest first) along with whether we got all
+        the way back to `position`; if we didn't, some comments are missing.
+        """
+        stop = None
+        if position:
+            stop = base36decode(name_to_id(position))
+        result = []
+        for comment in self.reddit.get_comments(srname, limit=None):
+            if stop is not None and base36decode(comment.id) <= stop:
+                return result, True
+            result.append(comment)
+        return result, False
+
+    def mark_read(self, expander, post, comments):
+        """Have the expander skip these comments, once they're committed"""
+        self.reading.append((expander, post.fullname,
+                             [comment.name for comment in comments]))
+
+    def reading_committed(self, session):
+        if session.transaction.parent is None:
+            for expander, fullname, names in self.reading:
+                expander.mark_read(fullname, names)
+            self.reading = []
+            self.answered_committed.extend(self.answered)
+            self.answered = []
+
+    def reading_rolled_back(self, session):
+        if session.transaction.parent is None:
+            self.reading = []
+            self.answered = []
+
+    @failable
+    def process_battles(self, fetched):
+        if not fetched:
+            return
+        session = self.session
+        posts, streams = fetched
+        self.process_battle_threads(posts)
+        session.commit()
+
+        for srname, sub_battles, comments, sub_posts in streams:
+            if sub_posts is None:
+                battle_ids = [battle_id for battle_id, _ in sub_battles]
+                self.process_comment_stream(comments, battle_ids)
+            else:
+                read = self.process_battle_threads(sub_posts)
+                if len(read) < len(sub_battles):
+                    continue  # Don't skip past what we couldn't read
+            if comments:
+                cursor = Cursor.named(session, "comments/%s" % srname)
+                cursor.position = comments[0].name
+            session.commit()
+
+    def process_battle_threads(self, posts):
+        """Process fetched battle threads
+
+        Returns the battles whose threads we were able to read completely;
+        huge threads may take a few loops to expand.
+        """
+        session = self.session
+        result = []
+        for battle_id, fetched in posts:
+            # The battle may have ended while we were fetching
+            battle = session.query(Battle).get(battle_id)
+            if battle and fetched:
+                post, complete = fetched
                 self.process_post_for_battle(post, battle, session)
+                if complete:
+                    result.append(battle)
+        return result
+
+    def process_comment_stream(self, comments, battle_ids):
+        session = self.session
+        routes = {}
+        for battle_id in battle_ids:
+            battle = session.query(Battle).get(battle_id)
+            if battle:
+                routes[battle.submission_id] = battle
+        # The listing is newest-first
+        for comment in reversed(comments):
+            battle = routes.get(comment.link_id)
+            if battle:
+                self.process_comment_for_battle(comment, battle, session)
 
     @failable
-    def check_hq(self):
+    def fetch_recruits(self):
+        """Download the comments in the latest recruitment thread"""
         hq = self.reddit.get_subreddit(self.config.headquarters)
         submissions = hq.get_new()
         for submission in submissions:
             if "[recruitment]" in submission.title.lower():
-                self.recruit_from_post(submission)
-                break  # Only recruit from the first one
+                # Only recruit from the first one
+                expander = self.recruit_expander
+                expander.forget_except([submission.fullname])
+                expander.expand(submission, expander.budget)
+                return (submission,
+                        praw.helpers.flatten_tree(submission.comments))
+
+    def recruit_from_comments(self, fetched):
+        if not fetched:
+            return
+        submission, comments = fetched
+        for comment in comments:
+            self.recruit_from_comment(comment)
+        self.mark_read(self.recruit_expander, submission, comments)
+        self.session.commit()
 
     @failable
-    def check_messages(self):
-        unread = reddit.get_unread(True, True)
+    def fetch_messages(self):
+        # Only now that they're committed can they safely be marked read
+        while self.answered_committed:
+            self.answered_committed.popleft().mark_as_read()
+        return list(self.reddit.get_unread(True, True))
+
+    @failable
+    def process_messages(self, unread):
         session = self.session
-        for comment in unread:
+        for comment in unread or []:
             # Only PMs, we deal with comment replies in process_post_for_battle
-            if not comment.was_comment:
-                seen = (session.query(Processed).
-                    filter_by(id36=comment.name).
-                    count())
-                if seen:
-                    continue
+            if not comment.was_comment and not self.seen.has(comment.name):
+                self.activity += 1
                 player = self.find_player(comment, session)
                 if player:
                     cmds = extract_command(comment.body)
@@ -71,7 +289,7 @@ class Bot(object):
                         self.command(cmd, context)
                 session.add(Processed(id36=comment.name))
                 session.commit()
-            comment.mark_as_read()
+            self.answered.append(comment)
 
     @failable
     def command(self, text, context):
@@ -80,7 +298,10 @@ class Bot(object):
                      (text, context.player.name))
         try:
             parsed = parse(text)
-            parsed.execute(context)
+            # A command that fails partway mustn't take the rest of the
+            # loop's work down with it
+            with context.session.savepoint():
+                parsed.execute(context)
         except ParseException as pe:
             result = (
                 "I'm sorry, I couldn't understand your command:"
@@ -89,19 +310,29 @@ class Bot(object):
                 "\nThe parsing error is below:\n\n"
                 "    %s") % (text, pe)
             context.reply(result)
+        except Exception:
+            # The savepoint has already undone whatever it did; the message
+            # still counts as processed, or it would only fail again
+            logging.exception("Error carrying out command: '%s'" % text)
+            context.reply(
+                "I'm sorry, something went wrong carrying out your command:"
+                "\n\n"
+                "> %s\n"
+                "\nNothing has been changed." % text)
 
     def find_player(self, comment, session):
         if comment.author:  # Some messages (mod invites) don't have authors
             player = session.query(User).filter_by(
             name=comment.author.name.lower()).first()
             if not player and getattr(comment, 'was_comment', None):
-                comment.reply(Command.FAIL_NOT_PLAYER %
-                                  self.config.headquarters)
+                OutboundMessage.queue(session, "reply", comment.name,
+                                      Command.FAIL_NOT_PLAYER %
+                                      self.config.headquarters)
             return player
         return None
 
     @failable
-    def generate_markdown_report(self, loop_start):
+    def generate_markdown_report(self):
         """
         Separate from the others as this logs to a sidebar rather than
         a file
@@ -112,7 +343,10 @@ class Bot(object):
         hq = self.reddit.get_subreddit(self.config.headquarters)
 
         cur = now()
-        elapsed = (cur - loop_start) + self.config["bot"]["sleep"]
+        elapsed = 0
+        if self.runtime:
+            # A frame is how often we get around to reading battles
+            elapsed = self.runtime.task_named("check_battles").period or 0
         version_str = version(self.config)
 
         bot_report = ("Bot Status:\n\n"
@@ -126,13 +360,13 @@ class Bot(object):
         # Keep an eye on it.
         hq.update_settings(description=report)
 
-    def generate_reports(self, loop_start):
-        logging.info("Generating reports")
-        self.generate_markdown_report(loop_start)
+    def generate_reports(self):
+        self.generate_markdown_report()
         rdir = self.config["bot"].get("report_dir")
         if not rdir:
             return
         s = self.session
+        metrics = self.metrics.summary()
         regions = s.query(Region).all()
         with open(os.path.join(rdir, "report.txt"), 'w') as url:
             urldict = {}
@@ -159,6 +393,11 @@ class Bot(object):
                 if r.battle:
                     if r.battle.has_started():
                         rdict['battle'] = 'underway'
+                        projection = r.battle.projection()
+                        rdict['projection'] = {
+                            'score': projection.totals(),
+                            'sectors': projection.score,
+                        }
                     else:
                         rdict['battle'] = 'preparing'
                 else:
@@ -172,42 +411,42 @@ class Bot(object):
                 udict['leader'] = u.leader
                 users[u.name] = udict
             jdict['users'] = users
+            jdict['metrics'] = metrics
             j.write(json.dumps(jdict, sort_keys=True, indent=4))
 
-    def process_post_for_battle(self, post, battle, sess):
-        p = sess.query(Processed).filter_by(battle=battle).all()
-        seen = [entry.id36 for entry in p]
+        with open(os.path.join(rdir, "metrics.json"), 'w') as m:
+            mdict = {}
+            mdict['generated'] = now()
+            mdict['window'] = self.metrics.window
+            mdict['phases'] = metrics
+            m.write(json.dumps(mdict, sort_keys=True, indent=4))
 
-        replaced = post.replace_more_comments(limit=None, threshold=0)
-        if replaced:
-            logging.info("Comments that went un-replaced: %s" % replaced)
+    def process_post_for_battle(self, post, battle, sess):
         flat_comments = praw.helpers.flatten_tree(
             post.comments)
 
         for comment in flat_comments:
-            if comment.name in seen:
-                continue
-            if not comment.author:  # Deleted comments don't have an author
-                continue
-            if comment.author.name.lower() == self.config.username.lower():
-                continue
-            cmds = extract_command(comment.body)
-            if cmds:
-                player = self.find_player(comment, sess)
-                if player:
-                    context = Context(player, self.config, sess,
-                                          comment, self.reddit)
-                    for cmd in cmds:
-                        self.command(cmd, context)
-            sess.add(Processed(id36=comment.name, battle=battle))
-            sess.commit()
+            self.process_comment_for_battle(comment, battle, sess)
+        self.mark_read(self.battle_expander, post, flat_comments)
 
-    @failable
-    def recruit_from_post(self, post):
-        post.replace_more_comments(threshold=0)
-        flat_comments = praw.helpers.flatten_tree(post.comments)
-        for comment in flat_comments:
-            self.recruit_from_comment(comment)
+    def process_comment_for_battle(self, comment, battle, sess):
+        if self.seen.has(comment.name, battle.id):
+            return
+        self.activity += 1
+        if not comment.author:  # Deleted comments don't have an author
+            return
+        if comment.author.name.lower() == self.config.username.lower():
+            return
+        cmds = extract_command(comment.body)
+        if cmds:
+            player = self.find_player(comment, sess)
+            if player:
+                context = Context(player, self.config, sess,
+                                      comment, self.reddit)
+                for cmd in cmds:
+                    self.command(cmd, context)
+        sess.add(Processed(id36=comment.name, battle=battle))
+        sess.commit()
 
     @failable
     def recruit_from_comment(self, comment):
@@ -254,7 +493,7 @@ class Bot(object):
                               newbie.team)
             newbie.region = cap
 
-            session.commit()
+            session.flush()
             logging.info("Created combatant %s", newbie)
 
             reply = ("Welcome to Chroma!  You are now a %s "
@@ -269,12 +508,12 @@ class Bot(object):
             if team:
                 reply = "%s\n\n%s" % (reply, team.greeting)
 
-            comment.reply(reply)
+            OutboundMessage.queue(session, "reply", comment.name, reply)
+            session.commit()
         else:
             #logging.info("Already registered %s", comment.author.name)
             pass
 
-    @failable
     def update_skirmish_summaries(self, skirmishes):
         c = Context(player=None,
                     config=self.config,
@@ -282,28 +521,93 @@ class Bot(object):
                     comment=None,
                     reddit=self.reddit)
         for s in skirmishes:
-            SkirmishCommand.update_summary(c, s)
+            SkirmishCommand.refresh_summary(c, s.get_root())
+        self.session.commit()
+
+    def underway_text(self, battle):
+        text = ("War is now at your doorstep!  Mobilize your armies! "
+                "The battle has begun now, and will end at %s.\n\n"
+                "> Enter your commands in this thread, prefixed with "
+                "'>'") % battle.ends_str()
+        projected = battle.projected_report(self.config)
+        return "%s\n\n%s" % (text, "\n\n".join(projected))
+
+    def update_battle_posts(self):
+        """Show each battle's latest projected score in its post
+
+        Only battles whose projection we're already keeping are looked at,
+        which is the ones people have been fighting in.
+        """
+        for battle_id in list(self.session.projections):
+            battle = self.session.query(Battle).get(battle_id)
+            if not battle or not battle.submission_id:
+                continue
+            if not battle.has_started():
+                continue
+            text = self.underway_text(battle)
+            if self.battle_posts.get(battle_id) != text:
+                OutboundMessage.queue_edit(self.session,
+                                           battle.submission_id, text)
+                self.battle_posts[battle_id] = text
+
+    def refresh_posts(self):
+        self.update_dirty_summaries()
+        self.update_battle_posts()
+
+    def update_dirty_summaries(self):
+        """Refresh every summary that's changed since we last looked"""
+        dirty = (self.session.query(SkirmishAction).
+                 filter_by(summary_dirty=True).all())
+        # One load per tree rather than a query per skirmish as we render;
+        # ended skirmishes come from battles that have just loaded theirs
+        for root in dirty:
+            root.load_tree()
+        self.update_skirmish_summaries(dirty)
 
     @failable
     def update_game(self):
+        due = self.scheduler.due()
+        if not due:
+            return
+        try:
+            self.update_due(due)
+        except:
+            # The transaction may be unusable; start afresh, and try again
+            # next time
+            self.session.rollback()
+            for kind in due:
+                self.scheduler.schedule(kind, now())
+            raise
+        finally:
+            for kind in due:
+                self.scheduler.reschedule(kind)
+
+    def update_due(self, due):
         session = self.session
-        MarchingOrder.update_all(session, self.config)
+        if "marching" in due:
+            MarchingOrder.update_all(session, self.config)
+
+        if "eternal" in due:
+            self.create_eternal_battles()
+
+        if "battle" in due or "skirmish" in due:
+            self.update_battles()
 
+        if "buff" in due:
+            db.Buff.update_all(session)
+
+    def create_eternal_battles(self):
+        session = self.session
         results = Region.update_all(session, self.config)
-        to_add = []
         for newternal in results['new_eternal']:
+            session.add(newternal)
+            session.flush()  # The thread needs to know the battle's id
             title = "The Eternal Battle Rages On"
-            post = InvadeCommand.post_invasion(title, newternal, self.reddit)
-            if post:
-                newternal.submission_id = post.name
-                to_add.append(newternal)
-            else:
-                logging.warn("Couldn't submit eternal battle thread")
-                session.rollback()
-        if to_add:
-            session.add_all(to_add)
-            session.commit()
+            InvadeCommand.post_invasion(title, newternal, session)
+        session.commit()
 
+    def update_battles(self):
+        session = self.session
         results = Battle.update_all(session, self.config)
 
         for ready in results['begin']:
@@ -315,13 +619,9 @@ class Bot(object):
             chosen = random.randint(0, chooserange)
             ready.ends = ready.display_ends - (chooserange / 2) + chosen
 
-            text = ("War is now at your doorstep!  Mobilize your armies! "
-                    "The battle has begun now, and will end at %s.\n\n"
-                    "> Enter your commands in this thread, prefixed with "
-                    "'>'") % ready.ends_str()
-            post = self.reddit.get_submission(
-                submission_id=name_to_id(ready.submission_id))
-            post.edit(text)
+            text = self.underway_text(ready)
+            OutboundMessage.queue_edit(session, ready.submission_id, text)
+            self.battle_posts[ready.id] = text
             session.commit()
 
         self.update_skirmish_summaries(results['skirmish_ended'])
@@ -360,42 +660,222 @@ class Bot(object):
                 report.append("# TIE")
 
             text = "\n".join(report)
-            post = self.reddit.get_submission(
-                submission_id=name_to_id(done.submission_id))
-            post.edit(text)
+            if done.submission_id:
+                OutboundMessage.queue_edit(session, done.submission_id, text)
 
             # Update all the skirmish summaries
             self.update_skirmish_summaries(done.toplevel_skirmishes())
+            self.battle_posts.pop(done.id, None)
 
             session.delete(done)
             session.commit()
-        db.Buff.update_all(session)
+
+    def prepare_outbox(self):
+        """Pick out the queued messages that are due to be sent"""
+        # Anything a failed send got out must not go out again
+        self.finish_outbox()
+        if now() < self.outbox_resume:
+            return []
+        batch = self.config["bot"].get("outbox_batch", 30)
+        return [(msg.id, msg.kind, msg.recipient, msg.subject, msg.body)
+                for msg in OutboundMessage.ready(self.session, batch)]
+
+    def send_outbox(self, ready):
+        """Send queued messages, noting what became of each
+
+        Stops as soon as reddit says we're posting too fast; the rest will
+        still be due once the rate limit has passed.
+        """
+        for msg_id, kind, recipient, subject, body in ready:
+            try:
+                sent = self.deliver(kind, recipient, subject, body)
+                self.outbox_sent.append((msg_id, body,
+                                         getattr(sent, "name", None), None))
+            except RateLimitExceeded as rle:
+                self.outbox_sent.append((msg_id, body, None, rle))
+                break
+            except REDDIT_ERRORS as e:
+                logging.warning("Couldn't send %s to %s: %s" %
+                                (kind, recipient, e))
+                self.outbox_sent.append((msg_id, body, None, e))
+            except Exception as e:
+                logging.exception("Error sending %s to %s" %
+                                  (kind, recipient))
+                self.outbox_sent.append((msg_id, body, None, e))
+
+    def deliver(self, kind, recipient, subject, body):
+        if kind == "pm":
+            return self.reddit.send_message(recipient, subject, body)
+        elif kind == "reply":
+            # Works for messages as well as comments, unlike get_info
+            return self.reddit._add_comment(recipient, body)
+        elif kind == "submit":
+            return self.reddit.submit(recipient, title=subject, text=body)
+        elif kind == "edit":
+            return self.reddit.get_info(thing_id=recipient).edit(body)
+        raise ValueError("Don't know how to send a '%s'" % kind)
+
+    def finish_outbox(self, _=None):
+        """Clear out what was sent and schedule retries for the rest
+
+        Works from outbox_sent rather than what send_outbox returned, which
+        is nothing.
+        """
+        session = self.session
+        results = list(self.outbox_sent)
+        for msg_id, body, name, error in results:
+            msg = session.query(OutboundMessage).get(msg_id)
+            if not msg:
+                continue
+            if error is None:
+                if msg.body != body:
+                    # A newer edit came in while this one was being sent
+                    continue
+                # e.g. sent_battle_submission; edits only care if they fail
+                sent = getattr(self, "sent_%s" % msg.callback, None)
+                if sent:
+                    sent(msg.callback_id, name)
+                session.delete(msg)
+            elif isinstance(error, RateLimitExceeded):
+                # Not the message's fault, so doesn't count as an attempt
+                self.outbox_resume = now() + error.sleep_time
+            elif not msg.failed(str(error), self.config):
+                logging.error("Giving up on sending %s after %d attempts" %
+                              (msg, msg.attempts))
+                gave_up = getattr(self, "gave_up_%s" % msg.callback, None)
+                if gave_up:
+                    gave_up(msg.callback_id)
+        session.commit()
+        # Only once they've all been dealt with, in case something raised
+        for _ in xrange(len(results)):
+            self.outbox_sent.popleft()
+
+    def sent_battle_submission(self, battle_id, name):
+        battle = self.session.query(Battle).get(battle_id)
+        if battle:  # It might be over already
+            battle.submission_id = name
+
+    def gave_up_battle_submission(self, battle_id):
+        # Without a thread the battle can never start, and its region
+        # could never be invaded again
+        battle = self.session.query(Battle).get(battle_id)
+        if battle and not battle.submission_id:
+            logging.error("Calling off %s, which never got a thread" %
+                          battle)
+            self.session.delete(battle)
+
+    def sent_skirmish_summary(self, skirmish_id, name):
+        skirmish = self.session.query(SkirmishAction).get(skirmish_id)
+        if skirmish:
+            skirmish.summary_id = name
+            # Anything that happened while the summary was queued
+            if skirmish.children:
+                skirmish.summary_dirty = True
+
+    def sent_summary_page(self, skirmish_id, name):
+        skirmish = self.session.query(SkirmishAction).get(skirmish_id)
+        if skirmish:
+            skirmish.summary_id = "%s,%s" % (skirmish.summary_id, name)
+            # The page before needs to link to this one
+            skirmish.summary_dirty = True
+
+    def gave_up_summary_edit(self, skirmish_id):
+        # The hashes say the pages are up to date; they aren't
+        skirmish = self.session.query(SkirmishAction).get(skirmish_id)
+        if skirmish:
+            skirmish.summary_hashes = None
+            skirmish.summary_dirty = True
 
     @failable
     def login(self):
         reddit.login(c.username, c.password)
         return True
 
+    def refresh(self):
+        self.config.refresh()
+        # Pick up deadlines that were written by something other than us
+        self.scheduler.sweep()
+
+    def idle_interval(self, name):
+        """How long the named task should wait before looking again
+
+        We look every active_sleep while people are playing, and double
+        the wait each time nothing new turns up, up to max_sleep.
+        """
+        bot = self.config["bot"]
+        longest = bot.get("max_sleep", bot.get("sleep", 60))
+        shortest = bot.get("min_sleep", 5)
+        active = bot.get("active_sleep", min(longest, 30))
+
+        last, activity = self.idle_sleep.get(name, (None, None))
+        if last is None or self.activity != activity:
+            interval = active
+        else:
+            # Back off the longer things stay quiet
+            interval = min(last * 2, longest)
+        interval = max(interval, shortest)
+        self.idle_sleep[name] = (interval, self.activity)
+        return interval
+
+    def task(self, name, interval, timeout=None, **stages):
+        """Make a Task, letting the config override its timing
+
+        The stages that touch the database each run as a single unit of
+        work, so a whole phase costs one commit, and a stage that raises
+        leaves nothing behind.
+        """
+        settings = self.config["bot"].get("tasks", {}).get(name, {})
+        for stage in ("prepare", "apply"):
+            if stage in stages:
+                stages[stage] = self.batched(stages[stage])
+        return Task(name, settings.get("interval", interval),
+                    timeout=settings.get("timeout", timeout), **stages)
+
+    def batched(self, fn):
+        def run(*args):
+            with self.session.unit_of_work():
+                # The CLI or a map patch may have changed things under us
+                World.of(self.session).check_database(self.session)
+                return fn(*args)
+        return run
+
+    def tasks(self):
+        # Game updates are cheap when nothing is due, so check often
+        shortest = self.config["bot"].get("min_sleep", 5)
+        return [
+            self.task("refresh_config", 60, apply=self.refresh),
+            self.task("check_hq", 300, timeout=300,
+                      fetch=self.fetch_recruits,
+                      apply=self.recruit_from_comments),
+            self.task("check_messages",
+                      partial(self.idle_interval, "check_messages"),
+                      timeout=120,
+                      fetch=self.fetch_messages,
+                      apply=self.process_messages),
+            self.task("check_battles",
+                      partial(self.idle_interval, "check_battles"),
+                      timeout=300,
+                      prepare=self.prepare_battles,
+                      fetch=self.fetch_battles,
+                      apply=self.process_battles),
+            self.task("update_game", shortest, apply=self.update_game),
+            # Often enough to keep up, rarely enough to batch reactions
+            self.task("update_summaries", 30, apply=self.refresh_posts),
+            # No timeout: an abandoned send would only be sent again
+            self.task("send_outbox", shortest,
+                      prepare=self.prepare_outbox,
+                      fetch=self.send_outbox,
+                      apply=self.finish_outbox),
+            self.task("generate_reports", 60, apply=self.generate_reports),
+        ]
+
     def run(self):
         logging.info("Bot started up")
         if self.config.bot.get("verbose_logging"):
             logging.info("Verbose logging enabled")
-        logged_in = self.login()
-        while(logged_in):
-            loop_start = now()
-            self.config.refresh()
-            logging.info("Checking headquarters")
-            self.check_hq()
-            logging.info("Checking Messages")
-            self.check_messages()
-            logging.info("Checking Battles")
-            self.check_battles()
-            logging.info("Updating game state")
-            self.update_game()
-            # generate_reports logs itself
-            self.generate_reports(loop_start)
-            logging.info("Sleeping")
-            time.sleep(self.config["bot"]["sleep"])
+        if self.login():
+            self.runtime = Runtime(self.tasks(), self.metrics)
+            self.runtime.run()
         logging.fatal("Unable to log into bot; shutting down")
 
 if __name__ == '__main__':
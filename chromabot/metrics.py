@@ -0,0 +1,132 @@
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class Metrics(object):
+    """Rolling timings and counts for each phase of the bot's work
+
+    For every run of a phase we record how long it took, how many reddit
+    requests and SQL statements it made, and how many rows those statements
+    changed.  Work is attributed to whichever phase the current thread is
+    working for, so fetches running on other threads still count towards
+    the phase that asked for them.
+    """
+
+    COUNTERS = ("reddit_calls", "sql_statements", "rows")
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window=100):
+        self.window = window
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.runs = 0  # How many runs have begun, of any phase
+        # Phase -> (number of the run in progress, its counters)
+        self.running = {}
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def watch_engine(self, engine):
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+
+    def watch_reddit(self, reddit):
+        handler = getattr(reddit, "handler", None)
+        listeners = getattr(handler, "listeners", None)
+        if listeners is not None:
+            listeners.append(self.after_request)
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        self.count("sql_statements")
+        if cursor.rowcount > 0:  # Only meaningful for INSERT/UPDATE/DELETE
+            self.count("rows", cursor.rowcount)
+
+    def after_request(self):
+        self.count("reddit_calls")
+
+    def begin(self, phase):
+        with self.lock:
+            self.runs += 1
+            self.running[phase] = (self.runs,
+                                   dict((name, 0) for name in self.COUNTERS))
+
+    def end(self, phase, seconds):
+        with self.lock:
+            _, sample = self.running.pop(phase, (None, None))
+            if sample is None:
+                sample = dict((name, 0) for name in self.COUNTERS)
+            sample["seconds"] = seconds
+            self.samples[phase].append(sample)
+
+    def current_run(self, phase):
+        with self.lock:
+            return self.running.get(phase, (None, None))[0]
+
+    def count(self, what, amount=1):
+        phase = getattr(self.local, "phase", None)
+        if phase is None:
+            return
+        with self.lock:
+            run, counters = self.running.get(phase, (None, None))
+            # Work for a run that's since ended, like an abandoned fetch
+            # that's still going, doesn't count towards the next one
+            if counters is not None and run == self.local.run:
+                counters[what] += amount
+
+    @contextmanager
+    def working_for(self, phase, run=None):
+        """Count work done in this block towards the phase's current run,
+        or the given one"""
+        if run is None:
+            run = self.current_run(phase)
+        previous = (getattr(self.local, "phase", None),
+                    getattr(self.local, "run", None))
+        self.local.phase, self.local.run = phase, run
+        try:
+            yield
+        finally:
+            self.local.phase, self.local.run = previous
+
+    def bind(self, fn, phase=None):
+        """Wrap fn so work it does on another thread counts towards `phase`
+
+        `phase` defaults to whatever the calling thread is working for.
+        Only the run of the phase that's going now gets the credit; if it's
+        over by the time the work is done, nobody does.
+        """
+        if phase is None:
+            phase = getattr(self.local, "phase", None)
+            run = getattr(self.local, "run", None)
+        else:
+            run = self.current_run(phase)
+
+        def bound(*args, **kwargs):
+            with self.working_for(phase, run):
+                return fn(*args, **kwargs)
+        return bound
+
+    @classmethod
+    def percentile(cls, ordered, pct):
+        """Nearest-rank percentile of an already sorted list"""
+        index = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+        return ordered[min(index, len(ordered) - 1)]
+
+    def summary(self):
+        """Percentiles of every measurement, per phase"""
+        result = {}
+        with self.lock:
+            samples = dict((phase, list(runs))
+                           for phase, runs in self.samples.items())
+        for phase, runs in samples.items():
+            if not runs:
+                continue
+            pdict = {"runs": len(runs), "last": runs[-1]}
+            for name in ("seconds",) + self.COUNTERS:
+                ordered = sorted(run[name] for run in runs)
+                stats = dict(("p%d" % pct, self.percentile(ordered, pct))
+                             for pct in self.PERCENTILES)
+                stats["max"] = ordered[-1]
+                pdict[name] = stats
+            result[phase] = pdict
+        return result
@@ -0,0 +1,44 @@
+import time
+from threading import Lock
+from timeit import default_timer as timer
+
+from praw.handlers import DefaultHandler
+
+
+class PacedHandler(DefaultHandler):
+    """A praw handler that can have more than one request in flight
+
+    praw's stock handler holds its rate limit lock for the whole of each
+    request, so threads sharing it end up waiting on each other's network
+    round trips.  This one still spaces the *start* of requests to each
+    domain by the configured api_request_delay, but lets the requests
+    themselves overlap.
+    """
+
+    pace_lock = Lock()
+    next_slot = {}  # Domain -> earliest time the next request may start
+
+    def __init__(self):
+        DefaultHandler.__init__(self)
+        self.listeners = []  # Called for every request that goes out
+
+    @classmethod
+    def wait_for_slot(cls, domain, delay):
+        with cls.pace_lock:
+            current = timer()
+            slot = max(cls.next_slot.get(domain, 0), current)
+            cls.next_slot[domain] = slot + delay
+        if slot > current:
+            time.sleep(slot - current)
+
+    def paced_request(self, _rate_domain, _rate_delay, request, proxies,
+                      timeout, verify, **_):
+        self.wait_for_slot(_rate_domain, _rate_delay)
+        for listener in self.listeners:
+            listener()
+        settings = self.http.merge_environment_settings(
+            request.url, proxies, False, verify, None)
+        return self.http.send(request, timeout=timeout, allow_redirects=False,
+                              **settings)
+
+PacedHandler.request = DefaultHandler.with_cache(PacedHandler.paced_request)
@@ -1,25 +1,21 @@
+from sqlalchemy.orm.session import Session
 
+from db import Region
+from world import World
 
-def find_path(src, dest, team=None, traverse_neutrals=False):
-    queue = []
-    examined = set((src,))
-    curr = (src,)
-    try:
-        while curr[-1] != dest:
-            region = curr[-1]
-            children = []
-            for border in region.borders:
-                enterable = border.enterable_by(
-                    team, traverse_neutrals=traverse_neutrals)
-                if team is None or enterable:
-                    if border in examined:
-                        continue
-                    examined.add(border)
-                    child = curr + (border,)
-                    children.append(child)
-            queue.extend(children)
-            curr = queue.pop(0)
-        else:
-            return curr
-    except IndexError:
+
+def find_path(src, dest, team=None, traverse_neutrals=False, fastest=False):
+    """The shortest path from src to dest, as a tuple of regions
+
+    With a team, the path only goes through regions that team can enter.
+    Shortest means fewest hops, or the quickest march if `fastest`.  The
+    searching is done by the session's World, which keeps the result
+    around for the next path from the same place.
+    """
+    sess = Session.object_session(src)
+    path = World.of(sess).path(sess, src.id, dest.id, team,
+                               traverse_neutrals, fastest)
+    if path is None:
         return None
+    regions = sess.query(Region)
+    return tuple(regions.get(region_id) for region_id in path)
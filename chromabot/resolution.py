@@ -0,0 +1,232 @@
+"""Skirmish resolution, independent of the database
+
+The skirmishes to resolve are handed over as a Forest: parallel lists with
+one entry per skirmish, in post-order, so every skirmish comes after all of
+its children.  That lets a single pass over the lists resolve everything,
+with no recursion and no database access.
+"""
+
+
+def buffed(amount, buffs):
+    """The amount after applying each buff's value in turn"""
+    for value in buffs:
+        amount += (value * amount)
+    return int(amount)
+
+
+def type_adjusted(our_type, other_type, amount, support=False):
+    """Certain types will be more effective vs. a skirmish of our_type"""
+    if support:
+        ordering = ["cavalry", "infantry", "ranged"]
+    else:
+        ordering = ["ranged", "infantry", "cavalry"]
+    our_index = ordering.index(our_type)
+    penalty = ordering[our_index - 1]
+    bonus = ordering[(our_index + 1) % len(ordering)]
+    result = amount
+    if other_type == penalty:
+        result = int(amount / 2)
+    elif other_type == bonus:
+        result = int(amount * 1.5)
+    return result
+
+
+class Forest(object):
+    """Skirmish trees flattened into parallel lists, children first"""
+
+    def __init__(self):
+        self.amount = []
+        self.hinder = []
+        self.troop_type = []
+        self.team = []
+        self.buffs = []  # Each a list of buff values
+        self.parent = []  # Index of the parent, or None
+        self.toplevel = []  # True for root skirmishes
+
+    def __len__(self):
+        return len(self.amount)
+
+    def add(self, amount, hinder, troop_type, team, buffs=(), parent=None,
+            toplevel=True):
+        """Add a skirmish and return its index
+
+        The parent can be set later, once it's been added itself.
+        """
+        self.amount.append(amount)
+        self.hinder.append(hinder)
+        self.troop_type.append(troop_type)
+        self.team.append(team)
+        self.buffs.append(list(buffs))
+        self.parent.append(parent)
+        self.toplevel.append(toplevel)
+        return len(self.amount) - 1
+
+
+class Results(object):
+    """What resolve() worked out, in the same order as the forest"""
+
+    def __init__(self, size=0):
+        self.victor = []
+        self.margin = []
+        self.vp = []
+        self.unopposed = []
+        # VP per team from each skirmish's resolved children, and theirs.
+        # Like the rest of the rules, this assumes teams 0 and 1.
+        self.child_vp = []
+        self.extend(size)
+
+    def extend(self, size):
+        self.victor.extend([None] * size)
+        self.margin.extend([0] * size)
+        self.vp.extend([0] * size)
+        self.unopposed.extend([True] * size)
+        self.child_vp.extend([0, 0] for _ in xrange(size))
+
+
+def children_of(forest):
+    children = [[] for _ in xrange(len(forest))]
+    for index, parent in enumerate(forest.parent):
+        if parent is not None:
+            children[parent].append(index)
+    return children
+
+
+def settle(forest, results, children, i):
+    """Work out skirmish i, whose children have all been worked out"""
+    victor, margin, vp = results.victor, results.margin, results.vp
+    team = forest.team[i]
+    our_type = forest.troop_type[i]
+    victor[i] = team
+    margin[i] = buffed(forest.amount[i], forest.buffs[i])
+    vp[i] = 0
+    results.unopposed[i] = True
+    child_vp = results.child_vp[i] = [0, 0]
+    cap = margin[i]
+
+    if children[i]:
+        raw_support = forest.amount[i]
+        support = margin[i]
+        attack = 0
+        raw_attack = 0
+        for child in children[i]:
+            child_vp[0] += results.child_vp[child][0]
+            child_vp[1] += results.child_vp[child][1]
+            if victor[child] is not None:
+                child_vp[victor[child]] += vp[child]
+
+            if forest.hinder[child] == False:
+                # Support only counts if it didn't get ambushed on the way
+                if victor[child] == team:
+                    raw_support += margin[child]
+                    support += type_adjusted(our_type,
+                                             forest.troop_type[child],
+                                             margin[child], support=True)
+            elif forest.hinder[child] == True:
+                # Attackers only count if they weren't beaten by our team
+                if victor[child] != team:
+                    raw_attack += margin[child]
+                    attack += type_adjusted(our_type,
+                                            forest.troop_type[child],
+                                            margin[child])
+
+        results.unopposed[i] = attack == 0
+
+        if attack > support:
+            margin[i] = attack - support
+            victor[i] = [1, 0][team]
+            vp[i] += raw_support
+        elif support > attack:
+            margin[i] = support - attack
+            vp[i] += raw_attack
+        else:
+            # Nobody is the winner, but this skirmish is sure the loser
+            victor[i] = None
+            margin[i] = 0
+            vp[i] += max(raw_attack, raw_support)
+
+    # Support can't supply more than its initial numbers
+    if not forest.hinder[i]:
+        margin[i] = min(margin[i], cap)
+    if forest.toplevel[i]:
+        # A root is worth the VP of everything under it that went the same
+        # way it did, and double that if it went unopposed
+        if victor[i] is None:
+            vp[i] = 0
+        else:
+            vp[i] += child_vp[victor[i]]
+        if results.unopposed[i]:
+            vp[i] = max(vp[i] * 2, forest.amount[i] * 2)
+
+
+def resolve(forest):
+    results = Results(len(forest))
+    children = children_of(forest)
+    for i in xrange(len(forest)):
+        settle(forest, results, children, i)
+    return results
+
+
+class Projection(object):
+    """Provisional results for a forest that's still growing
+
+    Adding a skirmish only settles it and the skirmishes between it and its
+    root again, and the running score for that root's sector moves by
+    however much the root's result changed.  `keys` are whatever the caller
+    wants to look skirmishes up by, in forest order, and `sectors` maps the
+    index of each root to the sector it's in.
+    """
+
+    def __init__(self, forest, keys, sectors):
+        self.forest = forest
+        self.children = children_of(forest)
+        self.results = resolve(forest)
+        self.index = dict((key, i) for i, key in enumerate(keys))
+        self.sector = dict(sectors)
+        self.score = {}  # Sector -> VP for each team
+        for root in self.sector:
+            self.count(root, 1)
+
+    def count(self, root, sign):
+        victor = self.results.victor[root]
+        if victor is not None:
+            score = self.score.setdefault(self.sector[root], [0, 0])
+            score[victor] += sign * self.results.vp[root]
+
+    def settle_from(self, i):
+        path = []
+        while i is not None:
+            path.append(i)
+            i = self.forest.parent[i]
+        root = path[-1]
+        self.count(root, -1)
+        for i in path:
+            settle(self.forest, self.results, self.children, i)
+        self.count(root, 1)
+
+    def add(self, key, amount, hinder, troop_type, team, buffs=(),
+            parent=None, sector=0):
+        """Add a skirmish under the one keyed `parent`, or as a new root"""
+        if parent is not None:
+            parent = self.index[parent]
+        i = self.forest.add(amount, hinder, troop_type, team, buffs, parent,
+                            toplevel=parent is None)
+        self.index[key] = i
+        self.children.append([])
+        self.results.extend(1)
+        if parent is None:
+            self.sector[i] = sector
+        else:
+            self.children[parent].append(i)
+        self.settle_from(i)
+
+    def rebuff(self, key, buffs):
+        i = self.index[key]
+        self.forest.buffs[i] = list(buffs)
+        self.settle_from(i)
+
+    def totals(self):
+        result = [0, 0]
+        for score in self.score.values():
+            result[0] += score[0]
+            result[1] += score[1]
+        return result
@@ -0,0 +1,161 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from metrics import Metrics
+from utils import now
+
+
+class Task(object):
+    """One phase of the bot's work, run on its own schedule
+
+    A task has up to three stages.  `prepare` and `apply` run on the
+    runtime's own thread, which is the only one allowed to touch the
+    database.  `fetch` runs on a worker thread and should do nothing but
+    talk to reddit, so a slow fetch never holds up anyone else.  Each stage
+    is handed the result of the one before it.
+
+    `interval` is how many seconds to leave between the starts of
+    successive runs; it may be a callable if it changes over time.  A fetch
+    that runs longer than `timeout` seconds is abandoned, and the task
+    doesn't run again until the abandoned fetch has actually stopped.
+    """
+
+    def __init__(self, name, interval, apply=None, fetch=None, prepare=None,
+                 timeout=None):
+        self.name = name
+        self.interval = interval
+        self.apply = apply
+        self.fetch = fetch
+        self.prepare = prepare
+        self.timeout = timeout
+
+        self.next_run = 0
+        self.started = None
+        self.clock = None  # Precise start time, for metrics
+        self.period = None  # Seconds between the last two starts
+        self.pending = None  # The in-flight fetch, if any
+        self.abandoned = None  # A fetch we gave up on that's still going
+
+    def current_interval(self):
+        if callable(self.interval):
+            return self.interval()
+        return self.interval
+
+    def finished(self):
+        # If we overran, run again right away rather than trying to
+        # make up for lost runs
+        self.next_run = self.started + self.current_interval()
+
+    def __repr__(self):
+        return "<Task(name='%s')>" % self.name
+
+
+class Runtime(object):
+    """Runs a set of tasks, each on its own schedule
+
+    This thread is the single writer: everything that touches the database
+    happens here, one stage at a time, while the fetches run alongside on
+    a pool of their own.  A stage that raises is logged and that run is
+    over, but nothing else is affected.
+    """
+
+    POLL = 1  # Seconds between checks on in-flight fetches
+
+    def __init__(self, tasks, metrics=None):
+        self.tasks = tasks
+        self.metrics = metrics or Metrics()
+        fetchers = len([task for task in tasks if task.fetch])
+        self.pool = ThreadPool(max(fetchers, 1))
+
+    def task_named(self, name):
+        return next((task for task in self.tasks if task.name == name), None)
+
+    def run(self):
+        while True:
+            self.tick()
+            time.sleep(self.sleep_time())
+
+    def sleep_time(self):
+        cur = now()
+        waits = []
+        for task in self.tasks:
+            if task.pending is not None or task.abandoned is not None:
+                waits.append(self.POLL)
+            else:
+                waits.append(task.next_run - cur)
+        return max(min(waits), 0)
+
+    def tick(self):
+        for task in self.tasks:
+            self.poll(task)
+
+    def poll(self, task):
+        cur = now()
+        if task.abandoned is not None:
+            if not task.abandoned.ready():
+                return  # Never run two of the same fetch at once
+            logging.info("Abandoned %s has finished" % task.name)
+            task.abandoned = None
+        if task.pending is not None:
+            if task.pending.ready():
+                pending = task.pending
+                task.pending = None
+                try:
+                    fetched = pending.get()
+                except Exception:
+                    self.failed(task)
+                    return
+                self.finish(task, fetched)
+            elif task.timeout and cur - task.started > task.timeout:
+                logging.warning("%s took longer than %d seconds; abandoning "
+                                "it" % (task.name, task.timeout))
+                task.abandoned = task.pending
+                task.pending = None
+                self.metrics.end(task.name, time.time() - task.clock)
+                task.finished()
+        elif cur >= task.next_run:
+            self.start(task, cur)
+
+    def start(self, task, cur):
+        if task.started is not None:
+            task.period = cur - task.started
+        task.started = cur
+        task.clock = time.time()
+        logging.info("Running %s" % task.name)
+        self.metrics.begin(task.name)
+
+        args = ()
+        if task.prepare:
+            try:
+                with self.metrics.working_for(task.name):
+                    args = (task.prepare(),)
+            except Exception:
+                self.failed(task)
+                return
+        if task.fetch:
+            fetch = self.metrics.bind(task.fetch, task.name)
+            task.pending = self.pool.apply_async(fetch, args)
+        else:
+            self.finish(task, *args)
+
+    def finish(self, task, *args):
+        if task.apply:
+            try:
+                with self.metrics.working_for(task.name):
+                    task.apply(*args)
+            except Exception:
+                self.failed(task)
+                return
+        self.metrics.end(task.name, time.time() - task.clock)
+        elapsed = now() - task.started
+        if task.timeout and elapsed > task.timeout:
+            logging.warning("%s took %d seconds, longer than its %d second "
+                            "timeout" % (task.name, elapsed, task.timeout))
+        task.finished()
+
+    def failed(self, task):
+        """Give up on this run of the task; call from an except block"""
+        logging.exception("%s failed" % task.name)
+        self.metrics.end(task.name, time.time() - task.clock)
+        task.finished()
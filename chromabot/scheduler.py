@@ -0,0 +1,113 @@
+import heapq
+
+from sqlalchemy import event, func
+
+from db import Battle, Buff, MarchingOrder, SkirmishAction
+from utils import now
+
+
+class Scheduler(object):
+    """Keeps track of when the game state next needs updating
+
+    Rather than sweeping every table on every pass of the main loop, this
+    keeps a heap of upcoming deadlines (battles beginning and ending,
+    skirmishes ending, armies arriving and buffs expiring) and only reports
+    a kind of update as due once one of its deadlines has passed.
+
+    Deadlines are learned in two ways: by asking the database for the next
+    one after a kind of update has run, and by watching the session for
+    new or changed rows as they're flushed.  Entries are never removed
+    early, so a stale deadline just means an update that finds nothing to do.
+    Changes made outside this session, by the CLI for instance, only show
+    up once sweep() asks the database about everything.
+    """
+
+    KINDS = ("battle", "skirmish", "marching", "buff", "eternal")
+
+    def __init__(self, session):
+        self.session = session
+        self.heap = []
+        self.queued = set()
+        # We don't know what happened while we were down, so everything is
+        # due on startup
+        for kind in self.KINDS:
+            self.schedule(kind, 0)
+        event.listen(session, "after_flush", self.after_flush)
+
+    def after_flush(self, session, flush_context):
+        for obj in session.new.union(session.dirty):
+            self.watch(obj)
+        for obj in session.deleted:
+            if isinstance(obj, Battle):
+                # The region might need an eternal battle now
+                self.schedule("eternal", 0)
+
+    def due(self, when=None):
+        """Pop and return the set of kinds whose deadlines have passed"""
+        if when is None:
+            when = now()
+        result = set()
+        while self.heap and self.heap[0][0] <= when:
+            entry = heapq.heappop(self.heap)
+            self.queued.discard(entry)
+            result.add(entry[1])
+        return result
+
+    def sweep(self):
+        """Reschedule every kind of update from the database"""
+        for kind in self.KINDS:
+            self.reschedule(kind)
+        # Battles deleted elsewhere leave no deadline behind
+        self.schedule("eternal", now())
+
+    def reschedule(self, kind):
+        """Ask the database for the next deadline of the given kind"""
+        for when in self.next_from_db(kind):
+            if when is not None:
+                self.schedule(kind, when)
+
+    def next_from_db(self, kind):
+        q = self.session.query
+        if kind == "battle":
+            # Unstarted battles are waiting to begin, started ones to end
+            # (those without a thread yet are rescheduled when they get one)
+            return [q(func.min(Battle.begins)).
+                    filter(Battle.submission_id != None).
+                    filter(Battle.ends < Battle.begins).scalar(),
+                    q(func.min(Battle.ends)).
+                    filter(Battle.ends >= Battle.begins).scalar()]
+        elif kind == "skirmish":
+            return [q(func.min(SkirmishAction.ends)).
+                    filter(SkirmishAction.parent_id == None).
+                    filter(SkirmishAction.resolved == False).
+                    filter(SkirmishAction.ends > 0).scalar()]
+        elif kind == "marching":
+            return [q(func.min(MarchingOrder.arrival)).scalar()]
+        elif kind == "buff":
+            return [q(func.min(Buff.expires)).
+                    filter(Buff.expires > 0).scalar()]
+        # Eternal battles only need checking when a battle goes away
+        return []
+
+    def schedule(self, kind, when):
+        if when is None:
+            return
+        entry = (when, kind)
+        if entry not in self.queued:
+            self.queued.add(entry)
+            heapq.heappush(self.heap, entry)
+
+    def watch(self, obj):
+        """Schedule any deadline carried by the given model object"""
+        if isinstance(obj, MarchingOrder):
+            self.schedule("marching", obj.arrival)
+        elif isinstance(obj, Buff):
+            if obj.expires:
+                self.schedule("buff", obj.expires)
+        elif isinstance(obj, SkirmishAction):
+            if obj.ends and not obj.resolved:
+                self.schedule("skirmish", obj.ends)
+        elif isinstance(obj, Battle):
+            self.schedule("battle", obj.begins)
+            if obj.ends:
+                self.schedule("battle", obj.ends)
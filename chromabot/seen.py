@@ -0,0 +1,76 @@
+from sqlalchemy import event
+
+from db import Processed
+
+
+class SeenCache(object):
+    """Which comments and messages we've already processed
+
+    Backed by the processed table, but each battle's entries (and the ones
+    with no battle, which are PMs) are loaded once and then kept up to date
+    by watching the session, so checking a comment is a set lookup rather
+    than a query.  Entries that have been flushed but not yet committed
+    count too, until they're rolled back.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.battles = {}  # Battle id, or None for PMs -> set of fullnames
+        # Transaction -> (battle id, fullname) flushed but not committed
+        self.pending = {}
+        event.listen(session, "after_flush", self.after_flush)
+        event.listen(session, "after_commit", self.after_commit)
+        event.listen(session, "after_rollback", self.after_rollback)
+
+    @staticmethod
+    def owner(transaction):
+        """The savepoint or real transaction a flush belongs to"""
+        while not transaction.nested and transaction.parent is not None:
+            transaction = transaction.parent
+        return transaction
+
+    def after_flush(self, session, flush_context):
+        pending = self.pending.setdefault(self.owner(session.transaction),
+                                          set())
+        for obj in session.new:
+            if isinstance(obj, Processed):
+                pending.add((obj.battle_id, obj.id36))
+
+    def after_commit(self, session):
+        transaction = session.transaction
+        committed = self.pending.pop(transaction, set())
+        if transaction.nested:
+            # Only a savepoint; it's still up to whatever it's part of
+            parent = self.owner(transaction.parent)
+            self.pending.setdefault(parent, set()).update(committed)
+            return
+        for battle_id, id36 in committed:
+            if battle_id in self.battles:
+                self.battles[battle_id].add(id36)
+
+    def after_rollback(self, session):
+        transaction = session.transaction
+        if transaction.parent is None:
+            self.pending = {}
+        else:
+            self.pending.pop(transaction, None)
+
+    def for_battle(self, battle_id):
+        seen = self.battles.get(battle_id)
+        if seen is None:
+            rows = (self.session.query(Processed.id36).
+                    filter_by(battle_id=battle_id))
+            seen = self.battles[battle_id] = set(id36 for id36, in rows)
+        return seen
+
+    def has(self, fullname, battle_id=None):
+        if fullname in self.for_battle(battle_id):
+            return True
+        return any((battle_id, fullname) in pending
+                   for pending in self.pending.values())
+
+    def forget_except(self, battle_ids):
+        """Stop remembering battles other than the given ones"""
+        for battle_id in self.battles.keys():
+            if battle_id is not None and battle_id not in battle_ids:
+                del self.battles[battle_id]
@@ -4,9 +4,11 @@ import logging
 import time
 import unittest
 
-from chromabot import db
-from chromabot.db import (Battle, Processed, SkirmishAction)
+from chromabot import db, resolution
+from chromabot.commands import SkirmishCommand
+from chromabot.db import (Battle, OutboundMessage, Processed, SkirmishAction)
 from playtest import ChromaTest, MockConf
+from chromabot.seen import SeenCache
 from chromabot.utils import now
 
 
@@ -91,6 +93,35 @@ class TestBattle(ChromaTest):
 
         self.assert_(battle.is_ready())
 
+    def test_summary_refresh(self):
+        """Summaries are only edited when they've actually changed"""
+        s1, s2 = self.start_endable_skirmish()
+        self.battle.submission_id = "t3_test"
+        s1.summary_id = "t1_summary"
+        self.conf["game"]["sides"] = ["Orangered", "Periwinkle"]
+        context = self.context()
+
+        SkirmishCommand.update_summary(context, s2)
+        self.assertTrue(s1.summary_dirty)
+
+        SkirmishCommand.refresh_summary(context, s1)
+        self.assertFalse(s1.summary_dirty)
+        edits = self.sess.query(OutboundMessage).filter_by(kind="edit").all()
+        self.assertEqual(len(edits), 1)
+        self.assertEqual(edits[0].recipient, "t1_summary")
+        first = edits[0].body
+
+        # Nothing's changed, so nothing more to send
+        SkirmishCommand.refresh_summary(context, s1)
+        self.assertEqual(edits[0].body, first)
+
+        # Later changes replace the unsent edit rather than adding another
+        s1.react(self.carol, 1, hinder=False)
+        SkirmishCommand.refresh_summary(context, s1)
+        edits = self.sess.query(OutboundMessage).filter_by(kind="edit").all()
+        self.assertEqual(len(edits), 1)
+        self.assertNotEqual(edits[0].body, first)
+
     def test_skirmish_parenting(self):
         """Make sure I set up relationships correctly w/ skirmishes"""
         root = SkirmishAction()
@@ -106,6 +137,89 @@ class TestBattle(ChromaTest):
         self.assertEqual(a1.parent_id, root.id)
         self.assertEqual(a2.parent_id, root.id)
 
+    def test_bulk_load(self):
+        """Rendering a loaded battle doesn't go back to the database"""
+        self.conf["game"]["sides"] = ["Orangered", "Periwinkle"]
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s2 = s1.react(self.bob, 9)
+        s2.react(self.carol, 5)
+        s3 = s1.react(self.dave, 2, troop_type="cavalry")
+        s3.buff_with(db.Buff.first_strike())
+        self.battle.create_skirmish(self.dave, 5)
+        self.sess.commit()
+        expected = [root.full_details(config=self.conf)
+                    for root in self.battle.toplevel_skirmishes()]
+        self.sess.expire_all()
+
+        with self.counting_statements() as statements:
+            self.battle.load_skirmishes()
+            loaded = len(statements)
+            details = [root.full_details(config=self.conf)
+                       for root in self.battle.toplevel_skirmishes()]
+
+        self.assertEqual(details, expected)
+        self.assertLessEqual(loaded, 3)  # The battle, skirmishes, buffs
+        self.assertEqual(len(statements), loaded)
+
+    def test_root_and_depth(self):
+        """Skirmishes know their root and depth from the start"""
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s2 = s1.react(self.bob, 9)
+        s3 = s2.react(self.carol, 5)
+        s4 = s1.react(self.dave, 2)
+        self.sess.commit()
+
+        self.assertEqual([s.root_id for s in (s1, s2, s3, s4)], [s1.id] * 4)
+        self.assertEqual([s.depth for s in (s1, s2, s3, s4)], [0, 1, 2, 1])
+
+        with self.counting_statements() as statements:
+            self.assertEqual(s3.get_root(), s1)
+        self.assertEqual(statements, [])
+        self.assertEqual(s3.get_battle(), self.battle)
+
+        self.sess.expire_all()
+        root = s3.load_tree()
+        self.assertEqual(root, s1)
+        self.assertEqual(s1.children, [s2, s4])
+        self.assertEqual(s2.children, [s3])
+
+    def test_projection(self):
+        """The projected score keeps up without resolving anything"""
+        self.conf["game"]["sides"] = ["Orangered", "Periwinkle"]
+        s1 = self.battle.create_skirmish(self.alice, 10)
+        s1.react(self.bob, 9)
+        projection = self.battle.projection()
+        self.assertEqual(projection.totals(), [9, 0])
+
+        s2 = s1.react(self.carol, 5, hinder=False)
+        s2.buff_with(db.Buff.first_strike())
+        self.battle.create_skirmish(self.dave, 3)
+        self.assertIs(self.battle.projection(), projection)
+        self.assertFalse(s1.is_resolved())
+
+        SkirmishAction.resolve_all(self.battle.toplevel_skirmishes())
+        expected = [0, 0]
+        for root in self.battle.toplevel_skirmishes():
+            expected[root.victor] += root.vp
+        self.assertEqual(projection.totals(), expected)
+        self.assertEqual(self.battle.projected_report(self.conf)[2:],
+                         ["* Team Orangered: %d" % expected[0],
+                          "* Team Periwinkle: %d" % expected[1]])
+
+    def test_projection_rollback(self):
+        """A projection that saw rolled back skirmishes is thrown away"""
+        projection = self.battle.projection()
+        try:
+            with self.sess.unit_of_work():
+                self.battle.create_skirmish(self.alice, 10)
+                self.assertEqual(projection.totals(), [20, 0])
+                raise ValueError()
+        except ValueError:
+            pass
+        fresh = self.battle.projection()
+        self.assertIsNot(fresh, projection)
+        self.assertEqual(fresh.totals(), [0, 0])
+
     def test_battle_skirmish_assoc(self):
         """Make sure top-level skirmishes are associated with their battles"""
         battle = self.battle
@@ -148,6 +262,39 @@ class TestBattle(ChromaTest):
         self.assertEqual(self.sess.query(SkirmishAction).count(), 0)
         self.assertEqual(self.sess.query(db.Buff).count(), 0)
 
+    def test_seen_cache(self):
+        """Processed comments are remembered once committed"""
+        self.battle.processed_comments.append(Processed(id36="t1_old"))
+        self.sess.commit()
+
+        seen = SeenCache(self.sess)
+        self.assertTrue(seen.has("t1_old", self.battle.id))
+        self.assertFalse(seen.has("t1_old"))
+
+        self.sess.add(Processed(id36="t1_new", battle=self.battle))
+        self.sess.add(Processed(id36="t4_pm"))
+        self.sess.commit()
+        self.assertTrue(seen.has("t1_new", self.battle.id))
+        self.assertTrue(seen.has("t4_pm"))
+
+        self.sess.add(Processed(id36="t1_undone", battle=self.battle))
+        self.sess.flush()
+        self.sess.rollback()
+        self.assertFalse(seen.has("t1_undone", self.battle.id))
+
+        with self.sess.unit_of_work():
+            self.sess.add(Processed(id36="t1_kept", battle=self.battle))
+            self.sess.commit()
+            with self.sess.savepoint():
+                self.sess.add(Processed(id36="t1_dropped",
+                                        battle=self.battle))
+                self.sess.commit()
+                self.assertTrue(seen.has("t1_dropped", self.battle.id))
+                self.sess.rollback()
+            self.assertTrue(seen.has("t1_kept", self.battle.id))
+        self.assertTrue(seen.has("t1_kept", self.battle.id))
+        self.assertFalse(seen.has("t1_dropped", self.battle.id))
+
     def test_get_battle(self):
         """get_battle and get_root work, right?"""
         battle = self.battle
@@ -563,6 +710,51 @@ class TestBattle(ChromaTest):
         # With alice as the victor
         self.assertEqual(s1.victor, self.alice.team)
 
+    def test_only_due_skirmishes_end(self):
+        """Updating only picks up the skirmishes whose time is up"""
+        s1, s2 = self.start_endable_skirmish()
+        s3 = self.battle.create_skirmish(self.dave, 5, conf=self.conf)
+        s1.ends = 1
+        self.sess.commit()
+
+        updates = db.Battle.update_all(self.sess)
+
+        self.assertEqual(updates["begin"], [])
+        self.assertEqual(updates["ended"], [])
+        self.assertEqual(updates["skirmish_ended"], [s1])
+        self.assertTrue(s2.is_resolved())
+        self.assertFalse(s3.is_resolved())
+
+    def test_unposted_battle_waits(self):
+        """A battle doesn't begin until its thread has been posted"""
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        battle = londo.new_battle_here(now() - 10)
+        self.assertIsNone(battle.submission_id)
+
+        updates = db.Battle.update_all(self.sess)
+        self.assertNotIn(battle, updates["begin"])
+
+        battle.submission_id = "t3_londo"
+        self.sess.commit()
+        updates = db.Battle.update_all(self.sess)
+        self.assertIn(battle, updates["begin"])
+
+    def test_skirmish_ends_on_time(self):
+        """A skirmish is due the second it ends, as the scheduler says"""
+        s1, s2 = self.start_endable_skirmish()
+        cur = now()
+        s1.ends = cur
+        self.sess.commit()
+
+        real_now = db.now
+        db.now = lambda: cur
+        try:
+            updates = db.Battle.update_all(self.sess)
+        finally:
+            db.now = real_now
+        self.assertEqual(updates["skirmish_ended"], [s1])
+
     def test_skirmish_random_end(self):
         # 1 in 1800 chance this test fails, I can live with that.
         self.conf["game"]["skirmish_variability"] = 1800
@@ -1354,5 +1546,45 @@ class TestBattle(ChromaTest):
         # OR should get 25% bonus
         self.assertEqual(battle.score0, 13)
 
+class TestResolution(unittest.TestCase):
+
+    def test_forest(self):
+        forest = resolution.Forest()
+        # Children first: a support beaten by an ambush, under an attack
+        ambush = forest.add(3, True, "infantry", 1, toplevel=False)
+        support = forest.add(4, False, "infantry", 0, toplevel=False)
+        attack = forest.add(8, True, "infantry", 1, toplevel=False)
+        root = forest.add(10, True, "infantry", 0, buffs=[0.5])
+        forest.parent[ambush] = support
+        forest.parent[support] = root
+        forest.parent[attack] = root
+
+        results = resolution.resolve(forest)
+        self.assertEqual(results.victor[ambush], 1)
+        self.assertEqual(results.victor[support], 0)
+        self.assertEqual(results.margin[support], 1)
+        self.assertEqual(results.victor[root], 0)
+        self.assertEqual(results.margin[root], 8)
+        self.assertFalse(results.unopposed[root])
+        # 8 for beating the attack, 3 from the support's win
+        self.assertEqual(results.vp[root], 11)
+
+    def test_big_battle(self):
+        forest = resolution.Forest()
+        parent = None
+        for i in xrange(20000):
+            index = forest.add(1, i % 2 == 0, "infantry", i % 2,
+                               toplevel=False)
+            if parent is not None:
+                forest.parent[parent] = index
+            parent = index
+        forest.toplevel[parent] = True
+
+        began = time.time()
+        results = resolution.resolve(forest)
+        self.assertLess(time.time() - began, 2)
+        self.assertEqual(len(results.victor), 20000)
+
+
 if __name__ == '__main__':
     unittest.main()
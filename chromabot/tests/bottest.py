@@ -0,0 +1,659 @@
+import logging
+import socket
+import threading
+import time
+import unittest
+from timeit import default_timer as timer
+
+from praw.errors import RateLimitExceeded
+from praw.objects import MoreComments
+
+from chromabot.commands import InvadeCommand, StatusCommand
+from chromabot.db import (Battle, Cursor, OutboundMessage, Processed, Region,
+                          SkirmishAction, User)
+from chromabot.main import Bot
+from chromabot.pacing import PacedHandler
+from chromabot.runtime import Runtime, Task
+from chromabot.utils import now
+from playtest import ChromaTest, MockConf, TEST_LANDS
+
+
+class MockThing(object):
+    """A stand-in for any praw object; it has whatever it's given"""
+
+    def __init__(self, **kwargs):
+        self.replies = []
+        self.__dict__.update(kwargs)
+
+
+def mock_comment(name, author, body, link_id=None):
+    return MockThing(name=name, id=name[3:], author=MockThing(name=author),
+                     body=body, link_id=link_id, was_comment=True)
+
+
+class MockMore(MoreComments):
+
+    def __init__(self, children):
+        self._has_fetched = True  # Or praw tries to fetch what's missing
+        self.children = children
+
+
+class MockPost(MockThing):
+    """A thread with `top` comments, and `hidden` ones behind a "more"
+
+    Expanding the more records each comment's id in `expanded`.
+    """
+
+    def __init__(self, **kwargs):
+        self.hidden = {}
+        self.expanded = []
+        MockThing.__init__(self, **kwargs)
+
+    def fetched(self):
+        self.comments = list(self.top)
+        if self.hidden:
+            self.comments.append(MockMore(sorted(self.hidden)))
+
+    def replace_more_comments(self, limit=None, threshold=0):
+        for more in [item for item in self.comments
+                     if isinstance(item, MoreComments)]:
+            self.comments.remove(more)
+            for child in more.children:
+                self.expanded.append(child)
+                self.comments.append(self.hidden[child])
+        return []
+
+
+class MockReddit(object):
+    """Just enough of praw.Reddit for the bot to talk to"""
+
+    def __init__(self):
+        self.posts = {}  # Submission fullname -> MockPost
+        self.comments = {}  # Subreddit -> its comments, newest first
+        self.fetched = []  # Fullnames of the posts fetched
+        self.fetched_by = []  # Threads that called get_submission
+        self.on_fetch = None  # Called with each post as it's fetched
+        self.sent = []  # (kind, recipient, body) of everything sent
+        self.fail = None  # An exception to raise instead of sending
+        self.broken = set()  # Recipients that blow up unexpectedly
+        self.unread = []  # The inbox; marking a message read removes it
+
+    def get_submission(self, submission_id, comment_limit=None):
+        self.fetched.append("t3_%s" % submission_id)
+        self.fetched_by.append(threading.current_thread())
+        post = self.posts["t3_%s" % submission_id]
+        post.fetched()
+        if self.on_fetch:
+            self.on_fetch(post)
+        return post
+
+    def get_comments(self, srname, limit=None):
+        return iter(self.comments.get(srname, []))
+
+    def get_unread(self, unset_has_mail=False, update_user=False):
+        return iter(self.unread)
+
+    def message(self, name, author, body):
+        """Put a PM in the inbox"""
+        message = MockThing(name=name, author=MockThing(name=author),
+                            body=body, was_comment=False)
+        message.mark_as_read = lambda: self.unread.remove(message)
+        self.unread.append(message)
+        return message
+
+    def send(self, kind, recipient, body):
+        """Record something being sent, or fail to if we're set to"""
+        if self.fail:
+            raise self.fail
+        if recipient in self.broken:
+            raise AttributeError("'NoneType' object has no attribute 'reply'")
+        self.sent.append((kind, recipient, body))
+        prefix = {"submit": "t3", "reply": "t1"}.get(kind, "t4")
+        return MockThing(name="%s_sent%d" % (prefix, len(self.sent)))
+
+    def send_message(self, recipient, subject, body):
+        return self.send("pm", recipient, body)
+
+    def submit(self, srname, title, text):
+        return self.send("submit", srname, text)
+
+    def _add_comment(self, thing_id, text):
+        return self.send("reply", thing_id, text)
+
+    def get_info(self, thing_id):
+        return MockThing(edit=lambda body: self.send("edit", thing_id, body))
+
+
+class BotTest(ChromaTest):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        self.conf = MockConf(dbstring="sqlite://")
+        self.conf.username = "chromabot"
+        self.conf.headquarters = "chromahq"
+        self.reddit = MockReddit()
+        self.bot = Bot(self.conf, self.reddit)
+        self.db = self.bot.db
+        self.sess = self.bot.session
+        Region.create_from_json(self.sess, TEST_LANDS)
+
+        self.alice = self.create_user("alice", 0)
+        self.bob = self.create_user("bob", 1)
+
+    def tearDown(self):
+        self.bot.pool.terminate()
+
+
+class TestPacing(unittest.TestCase):
+
+    def test_spaced_starts(self):
+        """Requests from many threads still start a delay apart"""
+        starts = []
+
+        def request():
+            PacedHandler.wait_for_slot("pacing.test", 0.05)
+            starts.append(timer())
+        threads = [threading.Thread(target=request) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        starts.sort()
+        for before, after in zip(starts, starts[1:]):
+            self.assertGreaterEqual(after - before, 0.04)
+
+
+class TestFetchBattles(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.battles = []
+        for name in ("sapphire", "periopolis"):
+            region = self.sess.query(Region).filter_by(name=name).one()
+            region.owner = None
+            battle = region.new_battle_here(now())
+            battle.submission_id = "t3_%s" % name
+            self.reddit.posts[battle.submission_id] = MockPost(
+                fullname=battle.submission_id,
+                top=[mock_comment("t1_%s" % name, "alice", "hello")])
+            self.battles.append(battle)
+        self.sess.commit()
+
+    def test_concurrent_fetch(self):
+        """Threads are fetched side by side, and applied here"""
+        arrived = []
+        both = threading.Event()
+
+        def wait_for_both(post):
+            # Only gets past this if both fetches are running at once
+            arrived.append(post)
+            if len(arrived) == 2:
+                both.set()
+            both.wait(5)
+        self.reddit.on_fetch = wait_for_both
+
+        fetched = self.bot.fetch_battles(self.bot.prepare_battles())
+        self.assertTrue(both.is_set())
+        self.assertNotIn(threading.current_thread(), self.reddit.fetched_by)
+
+        self.bot.process_battles(fetched)
+        processed = self.sess.query(Processed).all()
+        self.assertEqual(sorted((p.id36, p.battle) for p in processed),
+                         [("t1_periopolis", self.battles[1]),
+                          ("t1_sapphire", self.battles[0])])
+
+    def read_battles(self):
+        prepared = self.bot.prepare_battles()
+        self.bot.process_battles(self.bot.fetch_battles(prepared))
+
+    def processed(self):
+        return sorted(p.id36 for p in self.sess.query(Processed))
+
+    def test_stream_cursor(self):
+        """Streaming moves the cursor along as it reads"""
+        self.conf["bot"]["battle_source"] = "stream"
+        self.reddit.comments["ct_sapphire"] = [
+            mock_comment("t1_a", "alice", "hello", "t3_sapphire")]
+        self.read_battles()
+        # With nowhere to start from, the thread had to be read in full
+        self.assertIn("t3_sapphire", self.reddit.fetched)
+        cursor = Cursor.named(self.sess, "comments/ct_sapphire")
+        self.assertEqual(cursor.position, "t1_a")
+
+        self.reddit.fetched = []
+        self.reddit.comments["ct_sapphire"].insert(
+            0, mock_comment("t1_b", "bob", "hi", "t3_sapphire"))
+        self.read_battles()
+        self.assertNotIn("t3_sapphire", self.reddit.fetched)
+        self.assertEqual(cursor.position, "t1_b")
+        self.assertEqual(self.processed(),
+                         ["t1_b", "t1_periopolis", "t1_sapphire"])
+
+    def test_stream_resume(self):
+        """A stored cursor is where streaming starts from"""
+        self.conf["bot"]["battle_source"] = "stream"
+        Cursor.named(self.sess, "comments/ct_sapphire").position = "t1_b"
+        self.sess.commit()
+        self.reddit.comments["ct_sapphire"] = [
+            mock_comment(name, "alice", "hello", "t3_sapphire")
+            for name in ("t1_c", "t1_b", "t1_a")]
+
+        self.read_battles()
+        self.assertNotIn("t3_sapphire", self.reddit.fetched)
+        self.assertEqual(self.processed(), ["t1_c", "t1_periopolis"])
+        self.assertEqual(
+            Cursor.named(self.sess, "comments/ct_sapphire").position, "t1_c")
+
+    def test_read_once_committed(self):
+        """Comments only count as read once they've been processed"""
+        post = self.reddit.posts["t3_sapphire"]
+        post.hidden = {"x": mock_comment("t1_x", "bob", "hello")}
+
+        # Fetched, but never applied
+        self.bot.fetch_battles(self.bot.prepare_battles())
+        self.assertEqual(post.expanded, ["x"])
+
+        # Applied, but rolled back
+        fetched = self.bot.fetch_battles(self.bot.prepare_battles())
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                self.bot.process_battles(fetched)
+                raise ValueError("Oops")
+        self.assertEqual(post.expanded, ["x", "x"])
+
+        fetched = self.bot.fetch_battles(self.bot.prepare_battles())
+        with self.sess.unit_of_work():
+            self.bot.process_battles(fetched)
+        self.assertIn("t1_x", self.processed())
+        self.assertEqual(post.expanded, ["x", "x", "x"])
+
+        # Now there's nothing new to spend a request on
+        self.bot.fetch_battles(self.bot.prepare_battles())
+        self.assertEqual(post.expanded, ["x", "x", "x"])
+
+
+class TestMessages(BotTest):
+
+    def test_read_once_committed(self):
+        """Messages are only marked read after they're committed"""
+        self.reddit.message("t4_a", "stranger", "hi")
+
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                self.bot.process_messages(self.bot.fetch_messages())
+                raise ValueError("Oops")
+        unread = self.bot.fetch_messages()
+        self.assertEqual([message.name for message in unread], ["t4_a"])
+
+        with self.sess.unit_of_work():
+            self.bot.process_messages(unread)
+        # Still unread until the next fetch, which does the marking
+        self.assertEqual(len(self.reddit.unread), 1)
+        self.assertEqual(self.bot.fetch_messages(), [])
+        self.assertEqual(self.sess.query(Processed).filter_by(
+            id36="t4_a").count(), 1)
+
+    def test_command_error(self):
+        """A command that blows up is undone, answered and not retried"""
+        message = self.reddit.message("t4_b", "alice", "status")
+        alice = self.alice
+
+        def broken(command, context):
+            alice.loyalists = 1
+            self.sess.flush()
+            raise ValueError("Oops")
+        original = StatusCommand.execute
+        StatusCommand.execute = broken
+        try:
+            with self.sess.unit_of_work():
+                self.bot.process_messages(self.bot.fetch_messages())
+        finally:
+            StatusCommand.execute = original
+
+        self.assertEqual(self.alice.loyalists, 100)
+        self.assertEqual(self.sess.query(Processed).filter_by(
+            id36="t4_b").count(), 1)
+        reply = self.sess.query(OutboundMessage).filter_by(
+            kind="reply", recipient=message.name).one()
+        self.assertIn("something went wrong", reply.body)
+
+
+class TestIdleInterval(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.conf["bot"]["min_sleep"] = 5
+        self.conf["bot"]["active_sleep"] = 10
+        self.conf["bot"]["max_sleep"] = 60
+
+    def intervals(self, name, runs):
+        return [self.bot.idle_interval(name) for _ in xrange(runs)]
+
+    def test_backoff(self):
+        """Quiet spells mean looking less and less often"""
+        self.assertEqual(self.intervals("check_messages", 5),
+                         [10, 20, 40, 60, 60])
+
+    def test_busy(self):
+        """Something new means looking often again"""
+        self.intervals("check_messages", 3)
+        self.intervals("check_battles", 3)
+        stranger = MockThing(name="t4_a", author=MockThing(name="stranger"),
+                             body="hi", was_comment=False,
+                             mark_as_read=lambda: None)
+        self.bot.process_messages([stranger])
+
+        self.assertEqual(self.intervals("check_messages", 2), [10, 20])
+        self.assertEqual(self.intervals("check_battles", 2), [10, 20])
+
+    def test_bounds(self):
+        """Intervals never drop below min_sleep"""
+        self.conf["bot"]["active_sleep"] = 1
+        self.assertEqual(self.intervals("check_battles", 3), [5, 10, 20])
+
+
+class TestRuntime(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        self.ran = []
+
+    def tearDown(self):
+        self.runtime.pool.terminate()
+
+    def recorder(self, name):
+        def record(*args):
+            self.ran.append((name,) + args)
+            return name
+        return record
+
+    def wait_for(self, task):
+        """Tick until the task's fetch has been dealt with"""
+        for _ in xrange(500):
+            if task.pending is None:
+                return
+            time.sleep(0.01)
+            self.runtime.tick()
+        self.fail("%s never finished" % task.name)
+
+    def test_order(self):
+        """Due tasks run in order, and then wait out their intervals"""
+        first = Task("first", 60, apply=self.recorder("first"))
+        second = Task("second", 60, prepare=self.recorder("prepare"),
+                      apply=self.recorder("second"))
+        self.runtime = Runtime([first, second])
+
+        self.runtime.tick()
+        self.assertEqual(self.ran, [("first",), ("prepare",),
+                                    ("second", "prepare")])
+        self.assertEqual(second.next_run, second.started + 60)
+
+        self.runtime.tick()
+        self.assertEqual(len(self.ran), 3)
+
+        second.next_run = 0
+        self.runtime.tick()
+        self.assertEqual(self.ran[3:], [("prepare",), ("second", "prepare")])
+
+    def test_stage_exceptions(self):
+        """A stage blowing up only ends that run"""
+        def broken(*args):
+            raise ValueError("Oops")
+        tasks = [Task("prepare", 60, prepare=broken,
+                      apply=self.recorder("prepare")),
+                 Task("fetch", 60, fetch=broken,
+                      apply=self.recorder("fetch")),
+                 Task("apply", 60, apply=broken),
+                 Task("fine", 60, apply=self.recorder("fine"))]
+        self.runtime = Runtime(tasks)
+
+        self.runtime.tick()
+        self.wait_for(tasks[1])
+        self.assertEqual(self.ran, [("fine",)])
+        for task in tasks:
+            self.assertEqual(task.next_run, task.started + 60)
+        runs = self.runtime.metrics.summary()
+        self.assertEqual(sorted(runs), ["apply", "fetch", "fine", "prepare"])
+
+    def test_abandoned_fetch(self):
+        """A fetch that's taking too long is abandoned, but not overlapped"""
+        release = threading.Event()
+        started = threading.Event()
+        fetches = []
+
+        def slow():
+            fetches.append(threading.current_thread())
+            started.set()
+            release.wait(5)
+            return "slow"
+        task = Task("slow", 60, fetch=slow, apply=self.recorder("slow"),
+                    timeout=10)
+        self.runtime = Runtime([task])
+
+        self.runtime.tick()
+        self.assertTrue(started.wait(5))
+        task.started -= 11
+        self.runtime.tick()
+        self.assertIsNone(task.pending)
+        self.assertIsNotNone(task.abandoned)
+
+        # Due again, but the last one is still going
+        task.next_run = 0
+        self.runtime.tick()
+        self.assertIsNone(task.pending)
+        self.assertEqual(len(fetches), 1)
+
+        release.set()
+        task.abandoned.wait(5)
+        self.runtime.tick()
+        self.assertIsNone(task.abandoned)
+        self.wait_for(task)
+        self.assertEqual(len(fetches), 2)
+        # Only the second fetch was applied
+        self.assertEqual(self.ran, [("slow", "slow")])
+
+
+class TestTasks(BotTest):
+
+    def test_rollback(self):
+        """A task that fails leaves nothing behind in the database"""
+        def broken():
+            self.alice.loyalists = 1
+            self.sess.commit()
+            raise ValueError("Oops")
+        runtime = Runtime([self.bot.task("broken", 60, apply=broken)])
+        runtime.tick()
+        runtime.pool.terminate()
+
+        self.assertEqual(self.alice.loyalists, 100)
+
+
+class TestSendOutbox(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        self.conf["bot"]["outbox_attempts"] = 2
+        self.conf["bot"]["outbox_backoff"] = 10
+        self.sapphire = self.sess.query(Region).filter_by(
+            name="sapphire").one()
+
+    def send(self):
+        ready = self.bot.prepare_outbox()
+        self.bot.finish_outbox(self.bot.send_outbox(ready))
+        return ready
+
+    def invade(self):
+        battle = self.sapphire.invade(self.bob, now() + 60)
+        InvadeCommand.post_invasion("War!", battle, self.sess)
+        self.sess.commit()
+        return battle
+
+    def test_callbacks(self):
+        """Whoever's waiting on something we post is told its fullname"""
+        battle = self.invade()
+        skirmish = SkirmishAction(amount=10)
+        self.sess.add(skirmish)
+        self.sess.commit()
+        OutboundMessage.queue(self.sess, "reply", "t1_abc", "Summary",
+                              callback="skirmish_summary",
+                              callback_id=skirmish.id)
+        OutboundMessage.queue(self.sess, "pm", "alice", "Hello")
+        self.sess.commit()
+
+        self.send()
+        self.assertEqual([kind for kind, _, _ in self.reddit.sent],
+                         ["submit", "reply", "pm"])
+        self.assertEqual(battle.submission_id, "t3_sent1")
+        self.assertEqual(skirmish.summary_id, "t1_sent2")
+        self.assertEqual(self.sess.query(OutboundMessage).count(), 0)
+
+    def test_backoff(self):
+        """Failed sends are tried again later, until we give up"""
+        msg = OutboundMessage.queue(self.sess, "pm", "alice", "Hello")
+        self.sess.commit()
+        self.reddit.fail = socket.timeout()
+
+        self.send()
+        self.assertEqual(msg.attempts, 1)
+        self.assertAlmostEqual(msg.next_attempt, now() + 10, delta=1)
+        self.assertEqual(self.send(), [])
+
+        msg.next_attempt = 0
+        self.send()
+        self.assertEqual(msg.attempts, 2)
+        self.assertIsNone(msg.next_attempt)
+        self.assertEqual(self.send(), [])
+        self.assertEqual(self.reddit.sent, [])
+
+    def test_rate_limit(self):
+        """Being told we're posting too fast holds up the whole outbox"""
+        msg = OutboundMessage.queue(self.sess, "pm", "alice", "Hello")
+        self.sess.commit()
+        self.reddit.fail = RateLimitExceeded("RATELIMIT", "Slow down", None,
+                                             {"ratelimit": 60})
+
+        self.send()
+        self.assertEqual(msg.attempts, 0)
+        self.assertEqual(self.send(), [])
+
+        self.reddit.fail = None
+        self.bot.outbox_resume = 0
+        self.send()
+        self.assertEqual(len(self.reddit.sent), 1)
+
+    def test_message_reply(self):
+        """Replies to PMs go out just like replies to comments"""
+        OutboundMessage.queue(self.sess, "reply", "t4_abc", "Done")
+        self.sess.commit()
+
+        self.send()
+        self.assertEqual(self.reddit.sent, [("reply", "t4_abc", "Done")])
+        self.assertEqual(self.sess.query(OutboundMessage).count(), 0)
+
+    def test_unexpected_error(self):
+        """One message blowing up doesn't get the rest sent twice"""
+        for recipient in ("alice", "bob", "carol"):
+            OutboundMessage.queue(self.sess, "pm", recipient, "Hello")
+        self.sess.commit()
+        self.reddit.broken.add("bob")
+
+        self.send()
+        self.assertEqual([sent for _, sent, _ in self.reddit.sent],
+                         ["alice", "carol"])
+        self.assertEqual(self.sess.query(OutboundMessage).one().attempts, 1)
+
+    def test_recorded_as_sent(self):
+        """Whatever got sent is recorded, even if the batch never finishes"""
+        OutboundMessage.queue(self.sess, "pm", "alice", "Hello")
+        self.sess.commit()
+
+        self.bot.send_outbox(self.bot.prepare_outbox())
+        # No finish_outbox, as if the fetch had died before it returned
+        self.assertEqual(self.send(), [])
+        self.assertEqual(len(self.reddit.sent), 1)
+        self.assertEqual(self.sess.query(OutboundMessage).count(), 0)
+
+    def test_summary_edit_given_up(self):
+        """A summary edit we give up on is queued again next refresh"""
+        skirmish = SkirmishAction(amount=10, summary_id="t1_summary",
+                                  summary_hashes="abc")
+        self.sess.add(skirmish)
+        self.sess.flush()
+        OutboundMessage.queue_edit(self.sess, "t1_summary", "Summary",
+                                   callback="summary_edit",
+                                   callback_id=skirmish.id)
+        self.sess.commit()
+        self.reddit.fail = socket.timeout()
+
+        self.send()
+        self.assertEqual(skirmish.summary_hashes, "abc")
+        self.sess.query(OutboundMessage).one().next_attempt = 0
+        self.send()
+        self.assertIsNone(skirmish.summary_hashes)
+        self.assertTrue(skirmish.summary_dirty)
+
+    def test_battle_thread_given_up(self):
+        """A battle that never gets a thread is called off"""
+        self.reddit.fail = socket.timeout()
+        battle = self.invade()
+        battle_id = battle.id
+
+        self.send()
+        self.sess.query(OutboundMessage).one().next_attempt = 0
+        self.send()
+        self.assertIsNone(self.sess.query(Battle).get(battle_id))
+
+        # Which leaves the region free to be fought over
+        self.assertTrue(self.invade())
+
+
+class TestUpdateGame(BotTest):
+
+    def setUp(self):
+        BotTest.setUp(self)
+        # Get the startup sweep out of the way
+        self.bot.update_game()
+
+    def test_failed_update(self):
+        """A failed update is rolled back and tried again"""
+        def broken(due):
+            self.alice.loyalists = 1
+            self.sess.flush()
+            raise ValueError("Oops")
+        self.bot.update_due = broken
+        self.bot.scheduler.schedule("buff", 0)
+
+        with self.assertRaises(ValueError):
+            self.bot.update_game()
+        self.assertEqual(self.alice.loyalists, 100)
+        self.assertEqual(self.bot.scheduler.due(), set(["buff"]))
+
+    def test_battle_posts_queued(self):
+        """Battles edit their posts through the outbox as they go"""
+        self.conf["game"]["battle_time"] = 60
+        self.conf["game"]["battle_lockout"] = 0
+        self.conf["game"]["sides"] = ["Orangered", "Periwinkle"]
+        londo = self.get_region("Orange Londo")
+        battle = londo.new_battle_here(now() - 10)
+        battle.submission_id = "t3_londo"
+        self.sess.commit()
+
+        self.bot.update_game()
+        edit = self.sess.query(OutboundMessage).filter_by(
+            kind="edit", recipient="t3_londo").one()
+        self.assertIn("War is now at your doorstep", edit.body)
+
+        battle.ends = now() - 1
+        self.sess.commit()
+        self.bot.update_game()
+        edit = self.sess.query(OutboundMessage).filter_by(
+            kind="edit", recipient="t3_londo").one()
+        self.assertIn("The battle is complete", edit.body)
+        # Nothing went to reddit from the writer
+        self.assertEqual(self.reddit.sent, [])
+        self.assertEqual(self.reddit.fetched, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,24 @@
 import logging
+import os
 import random
+import shutil
+import tempfile
 import time
 import unittest
 from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
 
 from chromabot import db
 from chromabot.commands import Context, MoveCommand
-from chromabot.db import (DB, Battle, Region, MarchingOrder, User)
+from chromabot.db import (DB, Alias, Battle, Buff, CodeWord, Region,
+                          MarchingOrder, OutboundMessage, Processed,
+                          SkirmishAction, User)
+from chromabot.metrics import Metrics
+from chromabot.scheduler import Scheduler
 from chromabot.utils import now
+from chromabot.world import World
 
 
 TEST_LANDS = """
@@ -54,6 +65,10 @@ class MockConf(object):
     def game(self):
         return self['games']
 
+    @property
+    def bot(self):
+        return self['bot']
+
     def __getitem__(self, key):
         return self.confitems[key]
 
@@ -105,6 +120,19 @@ class ChromaTest(unittest.TestCase):
 
         return Region.get_region(name, self.context(player=as_who))
 
+    @contextmanager
+    def counting_statements(self):
+        """Collect the SQL of every statement run inside the block"""
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            event.remove(self.db.engine, "before_cursor_execute", count)
+
 
 class TestPatch(ChromaTest):
     def test_patch_add(self):
@@ -191,6 +219,27 @@ class TestPatch(ChromaTest):
 
         self.assertEqual(peri, periperi)
 
+    def test_patch_distances(self):
+        """Capital distances notice new borders"""
+        NEW_LANDS = """
+[
+    {
+        "name": "Periopolis",
+        "connections": ["Oraistedarg"]
+    }
+]
+"""
+        world = World.of(self.sess)
+        londo = self.get_region("Orange Londo")
+        peri = self.get_region("Periopolis")
+        self.assertEqual(world.capital_distance(self.sess, 0, londo.id), 1)
+        self.assertEqual(world.capital_distance(self.sess, 0, peri.id), 3)
+        self.assertEqual(world.capital_distance(self.sess, 1, peri.id), 0)
+
+        Region.patch_from_json(self.sess, NEW_LANDS)
+        self.assertEqual(world.capital_distance(self.sess, 0, peri.id), 1)
+        self.assertIs(World.of(self.db.session()), world)
+
 
 class TestRegions(ChromaTest):
 
@@ -230,6 +279,41 @@ class TestRegions(ChromaTest):
 
         self.assertEqual(a, b)
 
+    def test_world_lookups(self):
+        """Borders and ownership come from memory once the world's loaded"""
+        londo = self.get_region("Orange Londo")
+        sapphire = self.get_region("Sapphire")
+        peri = self.get_region("Periopolis")
+        self.assertTrue(londo.adjacent_to(sapphire))
+
+        with self.counting_statements() as statements:
+            self.assertTrue(sapphire.adjacent_to(londo))
+            self.assertFalse(londo.adjacent_to(peri))
+            self.assertTrue(londo.enterable_by(0))
+            self.assertFalse(sapphire.enterable_by(0))
+            self.assertTrue(sapphire.enterable_by(0, traverse_neutrals=True))
+            self.assertEqual(Region.capital_for(1, self.sess), peri)
+        self.assertEqual(statements, [])
+
+        # Until something changes
+        sapphire.owner = 0
+        self.assertTrue(sapphire.enterable_by(0))
+
+    def test_name_index(self):
+        """Names and aliases are looked up without going to the database"""
+        londo = self.get_region("Orange Londo")
+        londo.create_alias("OL")
+        regions = self.sess.query(Region).order_by(Region.id).all()
+        self.get_region("OL")
+
+        with self.counting_statements() as statements:
+            path = MoveCommand.expand_path(["ol", "sapphire", "periopolis"],
+                                           self.context())
+        self.assertEqual(path, [regions[2], regions[1], regions[0]])
+        lookups = [sql for sql in statements
+                   if "FROM regions" in sql or "FROM aliases" in sql]
+        self.assertEqual(lookups, [])
+
 
 class TestPlaying(ChromaTest):
 
@@ -327,6 +411,26 @@ class TestPlaying(ChromaTest):
         blondo = self.get_region("Best Londo")
         self.assertEqual(blondo, londo)
 
+    def test_codeword_cache(self):
+        """Codewords are only queried once, and kept up to date"""
+        self.alice.add_codeword('Best Londo', 'Orange Londo')
+        self.alice.add_codeword('Home', 'Oraistedarg')
+        self.alice.translate_codeword('home')
+
+        with self.counting_statements() as statements:
+            self.assertEqual(self.alice.translate_codeword('Home '),
+                             'Oraistedarg')
+            self.assertEqual(self.alice.translate_codeword('elsewhere'),
+                             'elsewhere')
+        self.assertEqual(statements, [])
+
+        self.alice.remove_codeword('home')
+        self.assertEqual(self.alice.translate_codeword('home'), 'home')
+        self.alice.remove_all_codewords()
+        self.assertEqual(self.alice.translate_codeword('best londo'),
+                         'best londo')
+        self.assertEqual(self.alice.codewords, [])
+
     def test_sector_movement(self):
         self.conf["game"]["num_sectors"] = 7
         sess = self.sess
@@ -1030,6 +1134,39 @@ class TestPlaying(ChromaTest):
             filter_by(leader=self.alice)).count()
         self.assertEqual(n, 0)
 
+    def test_bulk_arrivals(self):
+        """Lots of arrivals don't mean lots of statements"""
+        londo = self.get_region("Orange Londo")
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+        users = [self.create_user("marcher%d" % i, 0) for i in xrange(30)]
+        for user in users:
+            user.move(10, [londo, sapphire], 60 * 60)
+        for order in self.sess.query(MarchingOrder):
+            order.arrival = now()
+        # One of them's going to find Sapphire's been lost
+        self.sess.query(MarchingOrder).filter_by(
+            leader=users[0], dest=sapphire).one().arrival = now() + 1000
+        self.sess.commit()
+        sapphire.owner = 1
+        self.sess.commit()
+        # Nothing loaded, as after a restart
+        self.sess.expire_all()
+
+        with self.counting_statements() as statements:
+            arrived = MarchingOrder.update_all(self.sess)
+
+        self.assertEqual(len(arrived), 59)
+        self.assertLess(len(statements), 20)
+        # Destinations come in with the orders, not one at a time
+        lookups = [sql for sql in statements
+                   if "WHERE regions.id = ?" in sql]
+        self.assertEqual(lookups, [])
+        self.assertEqual(self.sess.query(MarchingOrder).count(), 1)
+        for user in users:
+            self.assertEqual(user.region, londo)
+
     def test_movement_multiplier(self):
         """Some lands are harder to enter/leave"""
         home = self.alice.region
@@ -1106,6 +1243,392 @@ class TestPlaying(ChromaTest):
         self.assertAlmostEqual(sappmove.arrival, then + (DAY * 4), delta=600)
 
 
+class TestScheduler(ChromaTest):
+
+    def setUp(self):
+        ChromaTest.setUp(self)
+        self.scheduler = Scheduler(self.sess)
+        # Get the startup sweep out of the way
+        for kind in self.scheduler.due():
+            self.scheduler.reschedule(kind)
+
+    def test_startup_sweep(self):
+        """Everything is due when the scheduler is first created"""
+        fresh = Scheduler(self.sess)
+        self.assertEqual(fresh.due(), set(Scheduler.KINDS))
+
+    def test_quiet(self):
+        """Nothing is due if nothing's happening"""
+        self.assertEqual(self.scheduler.due(), set())
+        self.assertEqual(self.scheduler.heap, [])
+
+    def test_marching_deadline(self):
+        """Marching orders are scheduled as they're created"""
+        DAY = 60 * 60 * 24
+        londo = self.get_region("Orange Londo")
+        order = self.alice.move(100, londo, DAY)[0]
+
+        self.assertEqual(self.scheduler.due(), set())
+        self.assertEqual(self.scheduler.due(order.arrival), set(["marching"]))
+
+        # Cheat and push back the arrival
+        order.arrival = now()
+        self.sess.commit()
+        self.assertEqual(self.scheduler.due(), set(["marching"]))
+
+    def test_reschedule_from_db(self):
+        """Deadlines can be recovered from the database"""
+        londo = self.get_region("Orange Londo")
+        londo.buff_with(Buff.otd())
+
+        fresh = Scheduler(self.sess)
+        fresh.due()
+        fresh.reschedule("buff")
+        expires = londo.buffs[0].expires
+        self.assertEqual(fresh.due(expires - 1), set())
+        self.assertEqual(fresh.due(expires), set(["buff"]))
+
+    def test_sweep(self):
+        """Deadlines written by someone else turn up on the next sweep"""
+        londo = self.get_region("Orange Londo")
+        # Straight to the table, as if it came from another process
+        expires = now() + 60
+        self.sess.execute(Buff.__table__.insert().values(
+            name="Otd", region_id=londo.id, expires=expires))
+        self.sess.commit()
+        self.assertEqual(self.scheduler.due(expires), set())
+
+        self.scheduler.sweep()
+        self.assertEqual(self.scheduler.due(), set(["eternal"]))
+        self.assertEqual(self.scheduler.due(expires), set(["buff"]))
+
+    def test_battle_deleted(self):
+        """Losing a battle means we should check for eternal ones"""
+        londo = self.get_region("Orange Londo")
+        londo.owner = None
+        battle = londo.invade(self.alice, now() + 60)
+        self.assertEqual(self.scheduler.due(now() + 60), set(["battle"]))
+
+        self.sess.delete(battle)
+        self.sess.commit()
+        self.assertEqual(self.scheduler.due(), set(["eternal"]))
+
+
+class TestMetrics(ChromaTest):
+
+    def setUp(self):
+        ChromaTest.setUp(self)
+        self.metrics = Metrics(window=3)
+        self.metrics.watch_engine(self.db.engine)
+
+    def test_sql_attribution(self):
+        """SQL only counts towards the phase that issued it"""
+        self.metrics.begin("update_game")
+        # Not working for anyone yet
+        self.sess.query(User).count()
+        with self.metrics.working_for("update_game"):
+            self.sess.query(User).count()
+            self.alice.loyalists = 50
+            self.sess.commit()
+        self.metrics.end("update_game", 1.5)
+
+        summary = self.metrics.summary()["update_game"]
+        self.assertEqual(summary["runs"], 1)
+        self.assertEqual(summary["last"]["seconds"], 1.5)
+        self.assertEqual(summary["last"]["rows"], 1)
+        self.assertGreaterEqual(summary["last"]["sql_statements"], 2)
+
+    def test_rolling_window(self):
+        """Only the most recent runs are kept"""
+        for seconds in [100, 1, 2, 3]:
+            self.metrics.begin("check_hq")
+            self.metrics.end("check_hq", seconds)
+
+        summary = self.metrics.summary()["check_hq"]
+        self.assertEqual(summary["runs"], 3)
+        self.assertEqual(summary["seconds"]["max"], 3)
+        self.assertEqual(summary["seconds"]["p50"], 2)
+
+    def test_bind(self):
+        """Work done through a bound function counts for its phase"""
+        self.metrics.begin("check_battles")
+        bound = self.metrics.bind(self.metrics.after_request,
+                                  "check_battles")
+        bound()
+        bound()
+        self.metrics.end("check_battles", 0)
+
+        summary = self.metrics.summary()["check_battles"]
+        self.assertEqual(summary["last"]["reddit_calls"], 2)
+
+    def test_abandoned_run(self):
+        """Work for a run that's over doesn't count towards the next"""
+        self.metrics.begin("check_battles")
+        bound = self.metrics.bind(self.metrics.after_request,
+                                  "check_battles")
+        bound()
+        self.metrics.end("check_battles", 0)
+        bound()  # Still going after being given up on
+
+        self.metrics.begin("check_battles")
+        bound()
+        with self.metrics.working_for("check_battles"):
+            self.metrics.after_request()
+        self.metrics.end("check_battles", 0)
+
+        summary = self.metrics.summary()["check_battles"]
+        self.assertEqual(summary["reddit_calls"]["max"], 1)
+        self.assertEqual(summary["last"]["reddit_calls"], 1)
+
+
+class MockComment(object):
+
+    def __init__(self, name, was_comment=True):
+        self.name = name
+        self.was_comment = was_comment
+        self.permalink = "http://reddit.com/comments/%s" % name
+
+
+class TestOutbox(ChromaTest):
+
+    def test_reply_queues(self):
+        """Replies wait in the outbox rather than going straight out"""
+        context = Context(self.alice, self.conf, self.sess,
+                          MockComment("t1_abc"), None)
+        context.reply("Hello")
+        context.reply("Hi there", pm=False)
+        self.sess.commit()
+
+        pm, reply = OutboundMessage.ready(self.sess)
+        self.assertEqual(pm.kind, "pm")
+        self.assertEqual(pm.recipient, "alice")
+        self.assertIn("t1_abc", pm.body)
+        self.assertEqual(reply.kind, "reply")
+        self.assertEqual(reply.recipient, "t1_abc")
+        self.assertEqual(reply.body, "Hi there")
+
+    def test_pm_command_replies_in_place(self):
+        """Commands sent by PM are answered in the same conversation"""
+        context = Context(self.alice, self.conf, self.sess,
+                          MockComment("t4_abc", was_comment=False), None)
+        msg = context.reply("Hello")
+        self.assertEqual(msg.kind, "reply")
+        self.assertEqual(msg.recipient, "t4_abc")
+
+    def test_backoff(self):
+        """Failed sends wait longer each time, then give up"""
+        self.conf["bot"]["outbox_attempts"] = 3
+        self.conf["bot"]["outbox_backoff"] = 10
+        msg = OutboundMessage.queue(self.sess, "pm", "alice", "Hello")
+        self.sess.commit()
+
+        self.assertTrue(msg.failed("Timeout", self.conf))
+        self.assertAlmostEqual(msg.next_attempt, now() + 10, delta=1)
+        self.assertEqual(OutboundMessage.ready(self.sess), [])
+
+        self.assertTrue(msg.failed("Timeout", self.conf))
+        self.assertAlmostEqual(msg.next_attempt, now() + 20, delta=1)
+
+        self.assertFalse(msg.failed("Timeout", self.conf))
+        self.assertIsNone(msg.next_attempt)
+        self.assertEqual(msg.last_error, "Timeout")
+
+
+class TestUnitOfWork(ChromaTest):
+
+    def test_batched_commits(self):
+        """Commits inside a unit of work wait for the end of it"""
+        with self.assertRaises(ValueError):
+            with self.sess.unit_of_work():
+                self.alice.loyalists = 50
+                self.sess.commit()
+                raise ValueError()
+        self.assertEqual(self.alice.loyalists, 100)
+
+        with self.sess.unit_of_work():
+            self.alice.loyalists = 50
+            self.sess.commit()
+        self.sess.rollback()
+        self.assertEqual(self.alice.loyalists, 50)
+
+    def test_savepoint_rollback(self):
+        """Rolling back in a savepoint only undoes that savepoint"""
+        with self.sess.unit_of_work():
+            self.bob.loyalists = 50
+            self.sess.commit()
+            with self.sess.savepoint():
+                self.alice.loyalists = 50
+                self.sess.commit()
+                self.sess.rollback()
+                # Still in a savepoint, so this can be undone too
+                self.alice.loyalists = 75
+                self.sess.rollback()
+                self.bob.loyalists = 60
+        self.assertEqual(self.alice.loyalists, 100)
+        self.assertEqual(self.bob.loyalists, 60)
+
+    def test_savepoint_exception(self):
+        """A savepoint that raises leaves the rest of the work alone"""
+        with self.sess.unit_of_work():
+            self.bob.loyalists = 50
+            with self.assertRaises(ValueError):
+                with self.sess.savepoint():
+                    self.alice.loyalists = 50
+                    raise ValueError()
+        self.assertEqual(self.alice.loyalists, 100)
+        self.assertEqual(self.bob.loyalists, 50)
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "chroma.db")
+        self.conf = MockConf(dbstring="sqlite:///%s" % path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pragma(self, db, name):
+        return db.engine.execute("PRAGMA %s" % name).scalar()
+
+    def test_sqlite_defaults(self):
+        """New connections get the production pragmas"""
+        db = DB(self.conf)
+        self.assertEqual(self.pragma(db, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(db, "synchronous"), 1)  # NORMAL
+        self.assertEqual(self.pragma(db, "busy_timeout"), 5000)
+
+    def test_sqlite_overrides(self):
+        """The config can change or turn off pragmas"""
+        self.conf.sqlite_pragmas = {"synchronous": "full",
+                                    "journal_mode": None}
+        db = DB(self.conf)
+        self.assertEqual(self.pragma(db, "journal_mode"), "delete")
+        self.assertEqual(self.pragma(db, "synchronous"), 2)  # FULL
+
+    def test_readers_dont_block(self):
+        """Reading while the bot is mid-write doesn't wait on it"""
+        db = DB(self.conf)
+        db.create_all()
+        writer = db.session()
+        with writer.unit_of_work():
+            writer.add(User(name="alice", team=0, loyalists=100))
+            writer.commit()
+            reader = DB(self.conf).session()
+            self.assertEqual(reader.query(User).count(), 0)
+            reader.close()
+        writer.close()
+
+
+class TestWorldVersion(unittest.TestCase):
+    """The bot noticing map changes made by other processes"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "chroma.db")
+        conf = MockConf(dbstring="sqlite:///%s" % path)
+        bot_db = DB(conf)
+        bot_db.create_all()
+        self.bot = bot_db.session()
+        Region.create_from_json(self.bot, TEST_LANDS)
+        self.world = World.of(self.bot)
+        # Like the CLI: the same database, but a World of its own
+        self.cli = DB(conf).session()
+
+    def tearDown(self):
+        self.bot.close()
+        self.cli.close()
+        shutil.rmtree(self.dir)
+
+    def region(self, sess, name):
+        return sess.query(Region).filter_by(name=name).one()
+
+    def check(self):
+        self.bot.commit()  # The bot's between ticks
+        self.world.check_database(self.bot)
+
+    def test_ownership(self):
+        """Regions changing hands elsewhere are noticed"""
+        sapphire = self.region(self.bot, "sapphire")
+        self.assertIsNone(self.world.owner(self.bot, sapphire.id))
+
+        self.region(self.cli, "sapphire").owner = 1
+        self.cli.commit()
+        self.check()
+        self.assertEqual(self.world.owner(self.bot, sapphire.id), 1)
+
+    def test_cancelled_battle(self):
+        """A battle deleted elsewhere doesn't lock its region up"""
+        sapphire = self.region(self.bot, "sapphire")
+        sapphire.new_battle_here(now() + 60)
+        self.check()
+        self.assertTrue(self.world.has_battle(self.bot, sapphire.id))
+
+        self.cli.delete(self.cli.query(Battle).one())
+        self.cli.commit()
+        self.check()
+        self.assertFalse(self.world.has_battle(self.bot, sapphire.id))
+
+    def test_alias(self):
+        """Aliases made elsewhere can be used straight away"""
+        self.assertIsNone(self.world.region_named(self.bot, "saph"))
+        sapphire = self.region(self.cli, "sapphire")
+        sapphire.create_alias("saph")
+        self.check()
+        self.assertEqual(self.world.region_named(self.bot, "saph"),
+                         sapphire.id)
+
+    def test_own_changes(self):
+        """Our own changes don't make us forget what we know"""
+        self.world.adjacency(self.bot)
+        self.region(self.bot, "sapphire").owner = 1
+        self.check()
+        self.assertIsNotNone(self.world.borders)
+
+
+class TestIndexes(ChromaTest):
+
+    def assertUsesIndex(self, query):
+        sql = str(query.statement.compile(
+            dialect=self.db.engine.dialect,
+            compile_kwargs={"literal_binds": True}))
+        plan = self.db.engine.execute("EXPLAIN QUERY PLAN %s" % sql)
+        detail = " ".join(str(row[-1]) for row in plan)
+        self.assertNotIn("SCAN", detail, "%s\n%s" % (sql, detail))
+        self.assertIn("INDEX", detail, "%s\n%s" % (sql, detail))
+
+    def test_hot_lookups(self):
+        """Lookups done for every command don't scan whole tables"""
+        q = self.sess.query
+        self.assertUsesIndex(q(User).filter_by(name="alice"))
+        self.assertUsesIndex(q(Region).filter_by(name="sapphire"))
+        self.assertUsesIndex(q(Region).filter_by(capital=0))
+        self.assertUsesIndex(q(Alias).filter_by(name="ol"))
+        self.assertUsesIndex(q(CodeWord).filter_by(code="a", user=self.alice))
+        self.assertUsesIndex(q(Processed).filter_by(id36="t1_a"))
+        self.assertUsesIndex(q(Processed.id36).filter_by(battle_id=1))
+        self.assertUsesIndex(q(Battle).filter_by(submission_id="t3_a"))
+        self.assertUsesIndex(q(MarchingOrder).
+                             filter(MarchingOrder.arrival <= now()))
+        self.assertUsesIndex(q(MarchingOrder).filter_by(leader=self.alice))
+        self.assertUsesIndex(q(SkirmishAction).filter_by(comment_id="t1_a"))
+        self.assertUsesIndex(q(SkirmishAction).
+                             filter_by(parent_id=1,
+                                       participant=self.alice))
+        self.assertUsesIndex(q(SkirmishAction).
+                             filter_by(participant=self.alice))
+        self.assertUsesIndex(q(SkirmishAction).filter_by(root_id=1))
+        self.assertUsesIndex(q(Buff).filter(Buff.expires > 0).
+                             filter(Buff.expires < now()))
+        self.assertUsesIndex(q(Battle).filter(Battle.begins <= now()))
+        self.assertUsesIndex(q(Battle).filter(Battle.ends <= now()).
+                             filter(Battle.started(now())))
+        self.assertUsesIndex(q(SkirmishAction).
+                             filter(SkirmishAction.ends > 0).
+                             filter(SkirmishAction.ends <= now()))
+
+
 class TestPathfinding(ChromaTest):
 
     def test_no_neutral_traversal(self):
@@ -1127,5 +1650,69 @@ class TestPathfinding(ChromaTest):
         path = MoveCommand.expand_path(["*", "Orange Londo"], self.context())
         self.assertIsNotNone(path)
 
+    def test_cached_paths(self):
+        """Paths are remembered until somebody's allowed somewhere new"""
+        self.alice.region = self.get_region("Oraistedarg")
+        self.sess.commit()
+        sapphire = self.get_region("Sapphire")
+        sapphire.owner = 0
+        self.sess.commit()
+
+        path = MoveCommand.expand_path(["*", "Sapphire"], self.context())
+        self.assertEqual([r.name for r in path],
+                         ["orange londo", "sapphire"])
+
+        with self.counting_statements() as statements:
+            again = MoveCommand.expand_path(["*", "Sapphire"],
+                                            self.context())
+        self.assertEqual(again, path)
+        # Only the name lookups; no searching
+        searches = [sql for sql in statements
+                    if "region_to_region" in sql or "battles" in sql]
+        self.assertEqual(searches, [])
+
+        sapphire.owner = 1
+        self.sess.commit()
+        path = MoveCommand.expand_path(["*", "Sapphire"], self.context())
+        self.assertIsNone(path)
+
+    def test_fastest_path(self):
+        """Pathfinding goes around slow regions when that's quicker"""
+        BYPASS = """
+[
+    {
+        "name": "Oraistedarg",
+        "connections": ["Upper Bypass"]
+    },
+    {
+        "name": "Upper Bypass",
+        "srname": "ct_upperbypass",
+        "connections": ["Lower Bypass"],
+        "owner": 0
+    },
+    {
+        "name": "Lower Bypass",
+        "srname": "ct_lowerbypass",
+        "connections": ["Sapphire"],
+        "owner": 0
+    }
+]
+"""
+        Region.patch_from_json(self.sess, BYPASS)
+        self.alice.region = self.get_region("Oraistedarg")
+        self.get_region("Sapphire").owner = 0
+        self.sess.commit()
+
+        path = MoveCommand.expand_path(["*", "Sapphire"], self.context())
+        self.assertEqual([r.name for r in path],
+                         ["orange londo", "sapphire"])
+
+        # Londo's now slow enough that the long way round is quicker
+        self.get_region("Orange Londo").travel_multiplier = 5
+        self.sess.commit()
+        path = MoveCommand.expand_path(["*", "Sapphire"], self.context())
+        self.assertEqual([r.name for r in path],
+                         ["upper bypass", "lower bypass", "sapphire"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,281 @@
+import heapq
+from collections import deque
+
+
+class World(object):
+    """The map, in memory
+
+    Regions and their borders almost never change, so rather than walking
+    the lazy-loaded relationships every time a question comes up, they're
+    loaded with a couple of queries and kept until a border changes.  One
+    World is shared by every session from the same DB.
+
+    Who can go where, and how quickly, changes more often: whenever a
+    region changes hands or its travel multiplier, or a battle starts or
+    ends.  Answers that depend on that are kept against `version`, which
+    goes up every time it happens.
+
+    Changes made by other processes are spotted through the WorldVersion
+    table, which every commit that changes any of this bumps; call
+    check_database() to forget everything if someone else has.
+    """
+
+    def __init__(self):
+        self.borders = None  # Region id -> ids of its borders, in order
+        self.border_pairs = None  # (Region id, id of one of its borders)
+        self.distances = None  # Team -> {region id: hops from its capital}
+        self.names = None  # Region names and aliases -> region id
+        self.version = 0
+        self.uncommitted = False  # Changed since the last commit
+        self.owners = None  # Region id -> owner, as of trees_version
+        self.multipliers = None  # Region id -> travel multiplier, likewise
+        self.capitals = None  # Team -> id of its capital, likewise
+        self.battling = None  # Ids of regions with a battle in them
+        # (start, team, traverse_neutrals, fastest) -> parents
+        self.trees = {}
+        self.trees_version = None
+        self.db_version = None  # The WorldVersion this was last good for
+
+    @classmethod
+    def of(cls, session):
+        world = session.info.get("world")
+        if world is None:
+            world = session.info["world"] = cls()
+        return world
+
+    def borders_changed(self):
+        self.borders = None
+        self.border_pairs = None
+        self.distances = None
+        self.ownership_changed()
+
+    def names_changed(self):
+        self.names = None
+        self.uncommitted = True
+
+    def ownership_changed(self):
+        self.version += 1
+        self.uncommitted = True
+
+    def committed(self):
+        self.uncommitted = False
+
+    def rolled_back(self):
+        # Whatever changed is back how it was, which is a change too
+        if self.uncommitted:
+            self.forget()
+            self.db_version = None
+            self.uncommitted = False
+
+    def forget(self):
+        """Drop everything, to be loaded again as it's needed"""
+        self.borders = None
+        self.border_pairs = None
+        self.distances = None
+        self.names = None
+        self.version += 1
+
+    def stored_version(self, session):
+        from db import WorldVersion
+        return session.query(WorldVersion.version).filter_by(id=1).scalar()
+
+    def bump(self, session):
+        """Note in the database that we've changed the map"""
+        from db import WorldVersion
+        stored = self.stored_version(session)
+        if stored != self.db_version:
+            # Somebody else changed it since we last looked, too
+            self.forget()
+        if stored is None:
+            session.add(WorldVersion(id=1, version=1))
+            session.flush()
+        else:
+            table = WorldVersion.__table__
+            session.execute(table.update().
+                            values(version=table.c.version + 1))
+        self.db_version = self.stored_version(session)
+
+    def check_database(self, session):
+        """Forget everything if another process has changed the map"""
+        stored = self.stored_version(session)
+        if stored != self.db_version:
+            self.forget()
+            self.db_version = stored
+
+    def region_named(self, session, name):
+        """The id of the region with that name or alias, if there is one"""
+        if self.names is None:
+            from db import Alias, Region
+            self.names = dict(session.query(Alias.name, Alias.region_id))
+            # Real names win over aliases
+            self.names.update(session.query(Region.name, Region.id))
+        return self.names.get(name)
+
+    def adjacency(self, session):
+        """Region id -> ids of the regions bordering it"""
+        if self.borders is None:
+            from db import region_to_region
+            self.borders = {}
+            self.border_pairs = set()
+            borders = session.query(region_to_region.c.left_id,
+                                    region_to_region.c.right_id)
+            for left, right in borders:
+                self.borders.setdefault(left, []).append(right)
+                self.border_pairs.add((left, right))
+        return self.borders
+
+    def adjacent(self, session, region_id, other_id):
+        """Whether other_id is one of region_id's borders"""
+        self.adjacency(session)
+        return (region_id, other_id) in self.border_pairs
+
+    def hops_from(self, start, adjacency):
+        """Region id -> how many borders it is from `start`"""
+        result = {start: 0}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for border in adjacency.get(current, ()):
+                if border not in result:
+                    result[border] = result[current] + 1
+                    queue.append(border)
+        return result
+
+    def load_distances(self, session):
+        adjacency = self.adjacency(session)
+        self.check_version(session)
+        self.distances = {}
+        for team, region_id in self.capitals.items():
+            self.distances[team] = self.hops_from(region_id, adjacency)
+
+    def capital_distance(self, session, team, region_id):
+        """How many borders the region is from team's capital, if it's
+        reachable at all"""
+        if self.distances is None:
+            self.load_distances(session)
+        return self.distances.get(team, {}).get(region_id)
+
+    def check_version(self, session):
+        if self.trees_version != self.version:
+            from db import Battle, Region
+            self.trees = {}
+            self.owners = {}
+            self.multipliers = {}
+            self.capitals = {}
+            regions = session.query(Region.id, Region.owner, Region.capital,
+                                    Region.travel_multiplier)
+            for region_id, owner, capital, multiplier in regions.order_by(
+                    Region.id):
+                self.owners[region_id] = owner
+                self.multipliers[region_id] = multiplier
+                if capital is not None:
+                    self.capitals.setdefault(capital, region_id)
+            self.battling = set(region_id for region_id, in
+                                session.query(Battle.region_id))
+            self.trees_version = self.version
+
+    def enterable(self, region_id, team, traverse_neutrals=False):
+        # Only once check_version's been called
+        owner = self.owners.get(region_id)
+        if owner is None and traverse_neutrals:
+            return True
+        return owner == team or region_id in self.battling
+
+    def enterable_by(self, session, region_id, team, traverse_neutrals=False):
+        """Whether the team can march into the region"""
+        self.check_version(session)
+        return self.enterable(region_id, team, traverse_neutrals)
+
+    def owner(self, session, region_id):
+        self.check_version(session)
+        return self.owners.get(region_id)
+
+    def capital(self, session, team):
+        """The id of the team's capital, if it has one"""
+        self.check_version(session)
+        return self.capitals.get(team)
+
+    def has_battle(self, session, region_id):
+        self.check_version(session)
+        return region_id in self.battling
+
+    def travel_cost(self, src, dest):
+        """What User.move charges for the hop, in multiples of its delay"""
+        return max(self.multipliers[src], self.multipliers[dest])
+
+    def path_tree(self, session, start, team=None, traverse_neutrals=False,
+                  fastest=False):
+        """Region id -> the one before it on the best path from start
+
+        The best path is the one with the fewest hops or, if `fastest`, the
+        one that takes the least time to march.  Only regions the team can
+        enter are included, or every region if there's no team.
+        """
+        self.check_version(session)
+        key = (start, team, traverse_neutrals, fastest)
+        parents = self.trees.get(key)
+        if parents is None:
+            def allowed(region_id):
+                return team is None or self.enterable(region_id, team,
+                                                      traverse_neutrals)
+            search = self.cheapest_from if fastest else self.nearest_from
+            parents = self.trees[key] = search(session, start, allowed)
+        return parents
+
+    def nearest_from(self, session, start, allowed):
+        """Breadth-first search from start"""
+        adjacency = self.adjacency(session)
+        parents = {start: None}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for border in adjacency.get(current, ()):
+                if border not in parents and allowed(border):
+                    parents[border] = current
+                    queue.append(border)
+        return parents
+
+    def cheapest_from(self, session, start, allowed):
+        """Dijkstra's algorithm from start, weighted by travel cost
+
+        Ties go to the path with fewer hops, and then to whichever was found
+        first, so where every region costs the same this agrees with
+        nearest_from.
+        """
+        adjacency = self.adjacency(session)
+        parents = {start: None}
+        best = {start: (0, 0)}
+        done = set()
+        found = 0
+        heap = [(0, 0, found, start)]
+        while heap:
+            cost, hops, _, current = heapq.heappop(heap)
+            if current in done:
+                continue
+            done.add(current)
+            for border in adjacency.get(current, ()):
+                if border in done or not allowed(border):
+                    continue
+                candidate = (cost + self.travel_cost(current, border),
+                             hops + 1)
+                if border not in best or candidate < best[border]:
+                    best[border] = candidate
+                    parents[border] = current
+                    found += 1
+                    heapq.heappush(heap, candidate + (found, border))
+        return parents
+
+    def path(self, session, start, dest, team=None, traverse_neutrals=False,
+             fastest=False):
+        """Ids of the regions on the best path from start to dest,
+        including both, or None if there's no way through"""
+        parents = self.path_tree(session, start, team, traverse_neutrals,
+                                 fastest)
+        if dest not in parents:
+            return None
+        result = []
+        while dest is not None:
+            result.append(dest)
+            dest = parents[dest]
+        result.reverse()
+        return result